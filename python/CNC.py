@@ -8,8 +8,16 @@ import os
 import re
 import sys
 import math
-from stat import ST_MTIME
+import mmap
+import shutil
+import hashlib
+import collections
+import multiprocessing
+from array import array
+from stat import ST_MTIME, ST_SIZE
+import time
 import string
+import numpy as np
 
 import undo
 import Macros
@@ -20,9 +28,41 @@ from dxf import DXF
 from bmath import *
 
 IDPAT    = re.compile(r".*\bid:\s*(.*?)\)")
-PARENPAT = re.compile(r"(.*)(\(.*?\))(.*)")
-CMDPAT   = re.compile(r"([A-Za-z])")
 BLOCKPAT = re.compile(r"^\(Block-([A-Za-z]+): (.*)\)")
+COMMENTPAT = re.compile(r"\(.*?\)")
+WORDPAT  = re.compile(r"([A-Za-z])([^A-Za-z]*)")
+SCANPAT  = re.compile(r"([GgMmZz])([^A-Za-z]*)")
+GCODEPAT = re.compile(r"[Gg]\s*([0-9.]+)")
+MOTION   = ("0","1","2","3","00","01","02","03")
+TOOLPAT  = re.compile(r"\(([^)]*(?:\bT\d+|dia|\d\s*mm)[^)]*)\)", re.I)
+
+LEVEL_CHUNK = 4096	# segments to split at once with Probe.splitLines()
+LEVEL_CACHE = 64*1024*1024	# max bytes of leveled files kept in LevelCache
+SCATTER_K   = 6		# nearest probe points used by ScatteredHeight
+LEVEL_TASK  = 2000	# lines of the blocks sent at once to a leveling process
+
+ARC_NUMPY = 64		# arc points above which numpy evaluates them at once
+ARC_STEPS = 4096	# cached arc steps, per radius and accuracy
+
+PLANNER_BUFFER     = 16		# moves planned ahead by the firmware
+JUNCTION_DEVIATION = 0.013	# mm, firmware cornering tolerance
+
+FEED_BOOST  = 1.5	# feed factor of the long straight moves
+FEED_LENGTH = 5.0	# mm, shortest straight move sped up
+FEED_ANGLE  = 60.0	# degrees, sharpest turn at the ends of a sped up move
+FEED_RADIUS = 1.0	# mm, arcs below this radius are slowed down
+
+DRILL_NEIGHBORS = 8	# nearest holes tried by the orderPoints() moves
+
+SIMPLIFY_ARC = 4	# fewest line segments replaced by an arc
+
+RETRACT_CLEARANCE = 1.0	# mm, height above the work of the shortest hops
+RETRACT_SLOPE     = 0.05	# retract height added per mm of hop length
+
+PACKED       = "XYZIJF"	# words stored by PackedBlock as fixed point numbers
+PACKED_SCALE = 10000	# fixed point units per mm (or inch)
+PACKED_NONE  = -2**31	# missing word in a PackedBlock column
+PACKED_TEXT  = -2	# gcode of a PackedBlock line kept as text
 
 #------------------------------------------------------------------------------
 # Return a value combined from two dictionaries new/old
@@ -36,6 +76,369 @@ def getValue(name,new,old,default=0.0):
 		except:
 			return default
 
+#------------------------------------------------------------------------------
+# Simulate the firmware motion planner on the straight moves start->end
+# with feed (mm/min, 0 for the maximum), speed and acceleration limits per
+# axis (mm/min and mm/s^2), trapezoidal speed profiles, junction deviation
+# cornering speeds and only lookahead moves known in advance.
+# The machine stops before the moves of index in stops.
+# @return time of each move in seconds
+#------------------------------------------------------------------------------
+def plannerTimes(start, end, feed, feedmax, accel, stops=(),
+		lookahead=PLANNER_BUFFER, deviation=JUNCTION_DEVIATION):
+	d = np.asarray(end, dtype=float) - np.asarray(start, dtype=float)
+	n = len(d)
+	if n==0: return np.zeros(0)
+	length = np.sqrt((d*d).sum(1))
+	u  = d / length[:,None]
+	au = np.abs(u)
+
+	# nominal speed and acceleration limited by each axis
+	with np.errstate(divide="ignore"):
+		vmax = (np.asarray(feedmax, dtype=float)/60.0/au).min(1)
+		a    = (np.asarray(accel,   dtype=float)/au).min(1)
+	feed = np.asarray(feed, dtype=float)/60.0
+	v    = np.where(feed>0.0, np.minimum(feed, vmax), vmax)
+
+	# maximum squared speed at each junction, entry of move i
+	w = np.zeros(n+1)
+	cos  = -(u[:-1]*u[1:]).sum(1)
+	sin2 = np.sqrt(np.clip(0.5*(1.0-cos), 0.0, 1.0))
+	with np.errstate(divide="ignore"):
+		junction = np.where(sin2 > 0.999999, np.inf,
+				a[1:]*deviation*sin2/(1.0-sin2))
+	w[1:-1] = np.minimum(junction, np.minimum(v[:-1], v[1:])**2)
+	w[list(stops)] = 0.0
+	w[-1] = 0.0
+
+	# speed reduction possible with 2*a*length in each move
+	c = np.zeros(n+1)
+	np.cumsum(2.0*a*length, out=c[1:])
+
+	# stop possible at the end of the moves in the planner buffer
+	last = np.minimum(np.arange(n+1)+lookahead-1, n)
+	w = np.minimum(w, c[last]-c)
+
+	# w[i] = min(w[i], w[i+1]+2 a l) backward (deceleration) and
+	# w[i+1] = min(w[i+1], w[i]+2 a l) forward (acceleration) passes
+	w = np.minimum.accumulate((w+c)[::-1])[::-1] - c
+	w = np.minimum.accumulate(w-c) + c
+	w = np.maximum(w, 0.0)
+
+	# trapezoidal (or triangular) profile of each move
+	v0 = np.sqrt(w[:-1])
+	v1 = np.sqrt(w[1:])
+	da = (v*v - w[:-1]) / (2.0*a)
+	dd = (v*v - w[1:])  / (2.0*a)
+	cruise = da+dd <= length
+	peak = np.where(cruise, v,
+		np.sqrt(np.maximum(a*length + 0.5*(w[:-1]+w[1:]), 0.0)))
+	return (2.0*peak - v0 - v1) / a + \
+		np.where(cruise, (length-da-dd)/v, 0.0)
+
+#------------------------------------------------------------------------------
+# Order paths to minimize the travel between them, starting from point start
+# and ending at point end (None for any). Path i is entered at entries[i]
+# and left at exits[i], paths with flippable[i] can be traversed reversed.
+# A nearest neighbor tour is improved with 2-opt and Or-opt moves until no
+# move helps or timeout seconds passed
+# @return list of (path index, reversed)
+#------------------------------------------------------------------------------
+def orderPaths(start, entries, exits, flippable, end=None, timeout=2.0):
+	stop  = time.time() + timeout
+	entries = np.asarray(entries, dtype=float).reshape(-1,2)
+	exits   = np.asarray(exits,   dtype=float).reshape(-1,2)
+	flip  = np.asarray(flippable, dtype=bool)
+	m = len(entries)
+	if m==0: return []
+
+	# nearest neighbor
+	left  = np.ones(m, dtype=bool)
+	order = []
+	rev   = []
+	p = np.asarray(start, dtype=float)
+	for k in range(m):
+		de = np.hypot(*(entries-p).T)
+		dx = np.where(flip, np.hypot(*(exits-p).T), np.inf)
+		de[~left] = np.inf
+		dx[~left] = np.inf
+		i = int(np.argmin(np.minimum(de, dx)))
+		r = bool(dx[i] < de[i])
+		order.append(i)
+		rev.append(r)
+		left[i] = False
+		if r:
+			p = entries[i]
+		else:
+			p = exits[i]
+
+	order = np.array(order)
+	rev   = np.array(rev)
+	S = np.asarray(start, dtype=float)
+	T = None
+	if end is not None: T = np.asarray(end, dtype=float)
+
+	def dist(a, b):
+		return np.hypot(a[...,0]-b[...,0], a[...,1]-b[...,1])
+
+	improved = True
+	while improved and time.time() < stop:
+		improved = False
+		E = np.where(rev[:,None], exits[order], entries[order])
+		X = np.where(rev[:,None], entries[order], exits[order])
+		fixed = np.cumsum(~flip[order])
+
+		# 2-opt: reverse route[i..j]
+		for i in range(m):
+			if time.time() > stop: break
+			if not flip[order[i]]: continue
+			if i: xp = X[i-1]
+			else: xp = S
+			j  = np.arange(i, m)
+			j  = j[fixed[j] == fixed[i]]	# only flippable paths
+			delta = dist(xp, X[j]) - dist(xp, E[i])
+			if T is not None:
+				en = np.vstack((E[1:], T))[j]
+				delta += dist(E[i], en) - dist(X[j], en)
+			else:
+				inside = j < m-1
+				en = E[np.minimum(j+1, m-1)]
+				delta += np.where(inside, dist(E[i], en) - dist(X[j], en), 0.0)
+			k = int(np.argmin(delta))
+			if delta[k] < -1e-9:
+				j = j[k]
+				order[i:j+1] = order[i:j+1][::-1].copy()
+				rev[i:j+1]   = ~rev[i:j+1][::-1]
+				E[i:j+1], X[i:j+1] = X[i:j+1][::-1].copy(), E[i:j+1][::-1].copy()
+				improved = True
+
+		# Or-opt: move a chain of 1 to 3 paths to a better position
+		for length in (1,2,3):
+			i = 0
+			while i+length <= m:
+				if time.time() > stop: break
+				if i: xp = X[i-1]
+				else: xp = S
+				if i+length < m: en = E[i+length]
+				else: en = T
+				gain = dist(xp, E[i])
+				if en is not None:
+					gain += dist(X[i+length-1], en) - dist(xp, en)
+				# route without the chain
+				ro = np.concatenate((order[:i], order[i+length:]))
+				rr = np.concatenate((rev[:i],   rev[i+length:]))
+				re_ = np.concatenate((E[:i], E[i+length:]))
+				rx = np.concatenate((X[:i], X[i+length:]))
+				# insert before position k
+				prevx = np.vstack((S[None,:], rx))
+				if T is not None:
+					nexte = np.vstack((re_, T[None,:]))
+					cost = dist(prevx, E[i]) + dist(X[i+length-1], nexte) \
+						- dist(prevx, nexte)
+				else:
+					cost = dist(prevx, E[i])
+					cost[:-1] += dist(X[i+length-1], re_) - dist(prevx[:-1], re_)
+				k = int(np.argmin(cost))
+				if cost[k] < gain-1e-9:
+					order = np.concatenate((ro[:k], order[i:i+length], ro[k:]))
+					rev   = np.concatenate((rr[:k], rev[i:i+length], rr[k:]))
+					E = np.concatenate((re_[:k], E[i:i+length], re_[k:]))
+					X = np.concatenate((rx[:k],  X[i:i+length], rx[k:]))
+					fixed = np.cumsum(~flip[order])
+					improved = True
+				i += 1
+
+	return [(int(i), bool(r)) for i,r in zip(order, rev)]
+
+#------------------------------------------------------------------------------
+# Sort points along a Hilbert curve
+# @return indices of points in curve order
+#------------------------------------------------------------------------------
+def hilbertOrder(points, bits=16):
+	p  = np.asarray(points, dtype=float).reshape(-1,2)
+	lo = p.min(0)
+	span = max((p.max(0)-lo).max(), 1e-9)
+	n  = 1<<bits
+	q  = ((p-lo)/span*(n-1)).astype(np.int64)
+	x  = q[:,0]
+	y  = q[:,1]
+	d  = np.zeros(len(p), dtype=np.int64)
+	s  = n>>1
+	while s:
+		rx = (x & s) > 0
+		ry = (y & s) > 0
+		d += s*s*((3*rx) ^ ry)
+		# rotate the quadrant
+		flip = rx & ~ry
+		x = np.where(flip, n-1-x, x)
+		y = np.where(flip, n-1-y, y)
+		x, y = np.where(ry, x, y), np.where(ry, y, x)
+		s >>= 1
+	return np.argsort(d, kind="mergesort")
+
+#------------------------------------------------------------------------------
+# Order points to minimize the travel from start through all of them and
+# to end (None for any). The Hilbert curve order is improved with 2-opt and
+# point move steps tried only towards the DRILL_NEIGHBORS nearest points,
+# found with the bucket index of ScatteredHeight, until no step helps or
+# timeout seconds passed
+# @return list of point indices
+#------------------------------------------------------------------------------
+def orderPoints(points, start, end=None, timeout=2.0):
+	stop = time.time() + timeout
+	n = len(points)
+	if n==0: return []
+	xs = [float(start[0])] + [float(p[0]) for p in points]
+	ys = [float(start[1])] + [float(p[1]) for p in points]
+	if end is not None:
+		xs.append(float(end[0]))
+		ys.append(float(end[1]))
+	N    = len(xs)
+	last = n	# last position that can change
+	tour = [0] + [int(i)+1 for i in hilbertOrder(points)]
+	if end is not None: tour.append(N-1)
+	pos  = [0]*N
+	for k,v in enumerate(tour): pos[v] = k
+
+	index = ScatteredHeight([(xs[i],ys[i],i) for i in range(1,n+1)],
+			DRILL_NEIGHBORS+1)
+	neighbors = [()]
+	for i in range(1,n+1):
+		neighbors.append([int(p[2]) for d2,p in index.nearest(xs[i],ys[i])
+					if int(p[2]) != i])
+
+	def dist(a, b):
+		if b is None: return 0.0	# open end
+		return math.hypot(xs[a]-xs[b], ys[a]-ys[b])
+
+	def after(k):
+		if k+1 < N: return tour[k+1]
+		return None
+
+	def renumber(lo, hi):
+		for k in range(lo, hi+1): pos[tour[k]] = k
+
+	improved = True
+	while improved and time.time() < stop:
+		improved = False
+		for a in range(1, n+1):
+			if time.time() > stop: break
+
+			# 2-opt: replace edges (a,a+1),(c,c+1) by (a,c),(a+1,c+1)
+			for c in neighbors[a]:
+				i, j = pos[a], pos[c]
+				if i > j: i, j = j, i
+				if j-i < 2 or j > last: continue
+				gain = dist(tour[i], tour[i+1]) + dist(tour[j], after(j)) \
+					- dist(tour[i], tour[j]) - dist(tour[i+1], after(j))
+				if gain > 1e-9:
+					tour[i+1:j+1] = tour[i+1:j+1][::-1]
+					renumber(i+1, j)
+					improved = True
+
+			# move a between c and its successor
+			p = pos[a]
+			prev = tour[p-1]
+			nxt  = after(p)
+			gain = dist(prev, a) + dist(a, nxt) - dist(prev, nxt)
+			for c in neighbors[a]:
+				q = pos[c]
+				if q == p-1 or q >= last+1 and end is not None: continue
+				s = after(q)
+				if dist(c, a) + dist(a, s) - dist(c, s) < gain - 1e-9:
+					del tour[p]
+					if q > p: q -= 1
+					tour.insert(q+1, a)
+					renumber(min(p,q+1), max(p,q+1))
+					improved = True
+					break
+
+	return [v-1 for v in tour[1:n+1]]
+
+#------------------------------------------------------------------------------
+# Douglas-Peucker simplification of a polyline, points is a Nx2 array
+# @return indices of the points kept, always including the first and last
+#------------------------------------------------------------------------------
+def douglasPeucker(points, tolerance):
+	n = len(points)
+	keep = np.zeros(n, dtype=bool)
+	keep[0] = keep[-1] = True
+	stack = [(0, n-1)]
+	while stack:
+		a, b = stack.pop()
+		if b-a < 2: continue
+		p  = points[a+1:b] - points[a]
+		d  = points[b] - points[a]
+		l2 = d.dot(d)
+		if l2 > 0.0:
+			t = np.clip(p.dot(d)/l2, 0.0, 1.0)
+			p = p - t[:,None]*d
+		dist = np.hypot(p[:,0], p[:,1])
+		k = int(np.argmax(dist))
+		if dist[k] > tolerance:
+			k += a+1
+			keep[k] = True
+			stack.append((a, k))
+			stack.append((k, b))
+	return np.nonzero(keep)[0]
+
+#------------------------------------------------------------------------------
+# Fit a circle through the first, middle and last of points (Nx2 array)
+# @return xc, yc, ccw, sweep angle, sagitta of the whole arc, or None if
+# a point or chord is further than tolerance from the arc, or the points
+# do not turn steadily in one direction
+#------------------------------------------------------------------------------
+def _fitArc(points, tolerance):
+	p  = points - points[0]
+	bx, by = p[len(p)//2]
+	cx, cy = p[-1]
+	d  = 2.0*(bx*cy - by*cx)
+	if abs(d) < 1e-12: return None
+	b2 = bx*bx + by*by
+	c2 = cx*cx + cy*cy
+	xc = (cy*b2 - by*c2)/d
+	yc = (bx*c2 - cx*b2)/d
+	r  = math.hypot(xc, yc)
+	if np.abs(np.hypot(p[:,0]-xc, p[:,1]-yc) - r).max() > tolerance:
+		return None
+	da = np.diff(np.arctan2(p[:,1]-yc, p[:,0]-xc))
+	da = (da + math.pi) % (2.0*math.pi) - math.pi
+	if not ((da > 0.0).all() or (da < 0.0).all()): return None
+	if r*(1.0-np.cos(np.abs(da).max()/2.0)) > tolerance: return None
+	sweep = abs(da.sum())
+	if sweep >= 2.0*math.pi-1e-3: return None
+	return xc+points[0][0], yc+points[0][1], bool(da[0] > 0.0), sweep, \
+		r*(1.0-math.cos(min(sweep, math.pi)/2.0))
+
+#------------------------------------------------------------------------------
+# Split a polyline (Nx2 array) in arcs of at least SIMPLIFY_ARC segments
+# and runs of lines. Each arc is grown from its first point as long as
+# all points stay within tolerance, and only kept when it curves more
+# than tolerance away from its chord
+# @return list of (first, last, (xc, yc, ccw) or None for lines)
+#------------------------------------------------------------------------------
+def fitArcs(points, tolerance):
+	n = len(points)
+	pieces = []
+	start = i = 0
+	while i < n-1:
+		best = None
+		for j in range(i+SIMPLIFY_ARC, n):
+			arc = _fitArc(points[i:j+1], tolerance)
+			if arc is None: break
+			if arc[4] > tolerance:
+				best = j, arc[:3]
+			elif j-i >= 4*SIMPLIFY_ARC:
+				break	# too flat, leave it to douglasPeucker()
+		if best is None:
+			i += 1
+			continue
+		if start < i: pieces.append((start, i, None))
+		pieces.append((i, best[0], best[1]))
+		start = i = best[0]
+	if start < n-1: pieces.append((start, n-1, None))
+	return pieces
+
 #==============================================================================
 # Probing class and linear interpolation
 #==============================================================================
@@ -64,18 +467,32 @@ class Probe:
 		self.points  = []	# probe points
 		self.matrix = []	# 2D matrix with Z coordinates
 		self.zeroed = False	# if probe was zeroed at any location
+		self._array = None	# numpy copy of matrix for batch calls
+		self._plane = None	# cached fitPlane() result
+		self.tolerance = 0.0	# max Z error of the leveled moves, 0=split on every grid line
+		self.arcs = False	# keep arcs as helical G2/G3 when within tolerance
+		self.planar = False	# use a fitted plane when it is within tolerance
+		self.clearance = 1.0	# lift above the last touch between probe points
+		self._measured = set()	# grid nodes (i,j) that were probed
+		self._cstep = 1		# node step of the coarse pass of adaptive scan
 
 	#----------------------------------------------------------------------
 	def clear(self):
 		del self.points[:]
 		del self.matrix[:]
 		self.zeroed = False	# if probe was zeroed at any location
+		self._array = None
+		self._plane = None
+		self._measured.clear()
 
 	#----------------------------------------------------------------------
 	def isEmpty(self): return len(self.matrix)==0
 
 	#----------------------------------------------------------------------
 	def makeMatrix(self):
+		self._array = None
+		self._plane = None
+		self._measured.clear()
 		del self.matrix[:]
 		for j in range(self.yn):
 			self.matrix.append([0.0]*(self.xn))
@@ -135,6 +552,18 @@ class Probe:
 			f.write("\n")
 		f.close()
 
+	#----------------------------------------------------------------------
+	# Return a string identifying the height map and leveling options
+	#----------------------------------------------------------------------
+	def signature(self):
+		sig = ["%r %r %d"%(self.xmin, self.xmax, self.xn),
+		       "%r %r %d"%(self.ymin, self.ymax, self.yn),
+		       "tolerance=%r arcs=%d planar=%d"%(self.tolerance,
+				int(self.arcs), int(self.planar))]
+		for row in self.matrix:
+			sig.append(" ".join(["%r"%(z) for z in row]))
+		return "\n".join(sig)
+
 	#----------------------------------------------------------------------
 	# Return step
 	#----------------------------------------------------------------------
@@ -148,19 +577,107 @@ class Probe:
 
 	#----------------------------------------------------------------------
 	def scan(self):
-		lines = []
 		self.makeMatrix()
-		for j in range(self.yn):
+		return self.scanLines([(i,j) for j in range(self.yn) for i in range(self.xn)])
+
+	#----------------------------------------------------------------------
+	# Return g-code probing the grid nodes (i,j) in serpentine order.
+	# Between points the probe is lifted only clearance above the last
+	# touch, zmax is used at the start and the end
+	#----------------------------------------------------------------------
+	def scanLines(self, nodes):
+		rows = {}
+		for i,j in nodes:
+			rows.setdefault(j,[]).append(i)
+
+		lines = ["G0Z%.4f\n"%(self.zmax)]
+		forward = True
+		for j in sorted(rows):
 			y = self.ymin + self._ystep*j
-			for i in range(self.xn):
+			for i in sorted(rows[j], reverse=not forward):
 				x = self.xmin + self._xstep*i
-				lines.append("G0Z%.4f\n"%(self.zmax))
 				lines.append("G0X%.4fY%.4f\n"%(x,y))
 				lines.append("G38.2Z%.4fF%g\n"%(self.zmin, self.feed))
+				lines.append("G91G0Z%.4f\n"%(self.clearance))
+				lines.append("G90\n")
+			forward = not forward
 		lines.append("G0Z%.4f\n"%(self.zmax))
 		lines.append("G0X%.4fY%.4f\n"%(self.xmin,self.ymin))
 		return lines
 
+	#----------------------------------------------------------------------
+	# Return the coarse grid indices, every step nodes plus the last one
+	#----------------------------------------------------------------------
+	@staticmethod
+	def _coarse(n, step):
+		idx = range(0, n, step)
+		if idx[-1] != n-1: idx.append(n-1)
+		return idx
+
+	#----------------------------------------------------------------------
+	# Adaptive scan, 1st pass: probe only every step grid nodes
+	#----------------------------------------------------------------------
+	def scanCoarse(self, step=2):
+		self.makeMatrix()
+		self._cstep = step
+		return self.scanLines([(i,j)
+				for j in self._coarse(self.yn, step)
+				for i in self._coarse(self.xn, step)])
+
+	#----------------------------------------------------------------------
+	# Adaptive scan, 2nd pass: once the coarse nodes are added, fill the
+	# rest of the matrix bilinearly and return the g-code probing the
+	# missing nodes of the coarse cells next to a node deviating more than
+	# threshold from the chord of its coarse neighbours (curvature)
+	#----------------------------------------------------------------------
+	def refine(self, threshold):
+		ci = self._coarse(self.xn, self._cstep)
+		cj = self._coarse(self.yn, self._cstep)
+		M  = self.matrix
+
+		# bilinear fill of the unmeasured nodes
+		for b in range(len(cj)-1):
+			j0, j1 = cj[b], cj[b+1]
+			for a in range(len(ci)-1):
+				i0, i1 = ci[a], ci[a+1]
+				for j in range(j0, j1+1):
+					v = float(j-j0)/(j1-j0)
+					for i in range(i0, i1+1):
+						if (i,j) in self._measured: continue
+						u = float(i-i0)/(i1-i0)
+						M[j][i] = (1.0-u)*(1.0-v)*M[j0][i0] + \
+							  u*(1.0-v)*M[j0][i1] + \
+							  (1.0-u)*v*M[j1][i0] + \
+							  u*v*M[j1][i1]
+		self._array = None
+		self._plane = None
+
+		def bent(idx, k, z):
+			# deviation of z[k] from the chord of z[k-1],z[k+1]
+			if k<=0 or k>=len(idx)-1: return 0.0
+			f = float(idx[k]-idx[k-1])/(idx[k+1]-idx[k-1])
+			return abs(z(k) - (z(k-1) + f*(z(k+1)-z(k-1))))
+
+		flagged = set()
+		for b in range(len(cj)):
+			for a in range(len(ci)):
+				dx = bent(ci, a, lambda k: M[cj[b]][ci[k]])
+				dy = bent(cj, b, lambda k: M[cj[k]][ci[a]])
+				if max(dx,dy) <= threshold: continue
+				for cb in (b-1, b):
+					for ca in (a-1, a):
+						if 0<=ca<len(ci)-1 and 0<=cb<len(cj)-1:
+							flagged.add((ca,cb))
+
+		nodes = set()
+		for a,b in flagged:
+			for j in range(cj[b], cj[b+1]+1):
+				for i in range(ci[a], ci[a+1]+1):
+					if (i,j) not in self._measured:
+						nodes.add((i,j))
+		if not nodes: return []
+		return self.scanLines(nodes)
+
 	#----------------------------------------------------------------------
 	# Add a probed point to the list and the 3D matrix
 	#----------------------------------------------------------------------
@@ -180,9 +697,41 @@ class Probe:
 
 		try:
 			self.matrix[int(j)][int(i)] = z
+			self._measured.add((int(i),int(j)))
+			self._array = None
+			self._plane = None
 		except IndexError:
 			pass
 
+	#----------------------------------------------------------------------
+	# Fill the matrix from all probed points, including the ones that do
+	# not lie on a grid node, using a ScatteredHeight model
+	#----------------------------------------------------------------------
+	def fitPoints(self, k=SCATTER_K, power=2.0):
+		if not self.points: return
+		model = ScatteredHeight(self.points, k, power)
+		self.makeMatrix()
+		self.xstep()
+		self.ystep()
+		for j,row in enumerate(self.matrix):
+			y = self.ymin + self._ystep*j
+			for i in range(len(row)):
+				row[i] = model(self.xmin + self._xstep*i, y)
+
+	#----------------------------------------------------------------------
+	# @return True if every grid node was probed and all the probed points
+	# lie on grid nodes, then the matrix needs no fitPoints()
+	#----------------------------------------------------------------------
+	def onGrid(self):
+		if len(self._measured) < self.xn*self.yn: return False
+		for x,y,z in self.points:
+			i = round((x-self.xmin) / self._xstep)
+			j = round((y-self.ymin) / self._ystep)
+			if not (0<=i<self.xn and 0<=j<self.yn): return False
+			if abs(x - (i*self._xstep + self.xmin)) > self._xstep/10.0: return False
+			if abs(y - (j*self._ystep + self.ymin)) > self._ystep/10.0: return False
+		return True
+
 	#----------------------------------------------------------------------
 	# Make z-level relative to the location of (x,y,0)
 	#----------------------------------------------------------------------
@@ -200,10 +749,54 @@ class Probe:
 				x = self.xmin + self._xstep*i
 				row[i] -= zero
 				self.points.append([x,y,row[i]])
+		self._array = None
+		self._plane = None
 		self.zeroed = True
 
+	#----------------------------------------------------------------------
+	# Return the Z matrix as a numpy array, cached until the matrix changes
+	#----------------------------------------------------------------------
+	def array(self):
+		if self._array is None:
+			self._array = np.array(self.matrix, dtype=float)
+		return self._array
+
+	#----------------------------------------------------------------------
+	# Fit a plane z=A*x+B*y+D on the matrix nodes with bmath.fitPlane
+	# return (A, B, D, max residual) or None if no plane could be fitted
+	#----------------------------------------------------------------------
+	def fitPlane(self):
+		if self._plane is None:
+			xyz = []
+			for j,row in enumerate(self.matrix):
+				y = self.ymin + self._ystep*j
+				for i,z in enumerate(row):
+					xyz.append((self.xmin + self._xstep*i, y, z))
+			self._plane = False
+			plane = xyz and fitPlane(xyz)
+			if plane and abs(plane[2]) > 1e-10:
+				a,b,c,d = plane
+				A, B, D = -a/c, -b/c, -d/c
+				res = max([abs(A*x + B*y + D - z) for x,y,z in xyz])
+				self._plane = (A, B, D, res)
+		return self._plane or None
+
+	#----------------------------------------------------------------------
+	# Return the plane (A,B,D) replacing the bilinear interpolation, when
+	# in planar mode and the plane fits all nodes within tolerance
+	#----------------------------------------------------------------------
+	def activePlane(self):
+		if not self.planar: return None
+		plane = self.fitPlane()
+		if plane is None or plane[3] > self.tolerance: return None
+		return plane[:3]
+
 	#----------------------------------------------------------------------
 	def interpolate(self, x, y):
+		plane = self.activePlane()
+		if plane is not None:
+			return plane[0]*x + plane[1]*y + plane[2]
+
 		ix = (x-self.xmin) / self._xstep
 		jy = (y-self.ymin) / self._ystep
 		i = int(math.floor(ix))
@@ -229,6 +822,131 @@ class Probe:
 		       a *b1 * self.matrix[j][i+1] + \
 		       a *b  * self.matrix[j+1][i+1]
 
+	#----------------------------------------------------------------------
+	# Batch version of interpolate() for arrays of x,y coordinates
+	# return an array with the Z correction of every point
+	#----------------------------------------------------------------------
+	def interpolateArray(self, x, y):
+		plane = self.activePlane()
+		if plane is not None:
+			return plane[0]*np.asarray(x, dtype=float) + \
+			       plane[1]*np.asarray(y, dtype=float) + plane[2]
+
+		Z  = self.array()
+		ix = (np.asarray(x, dtype=float)-self.xmin) / self._xstep
+		jy = (np.asarray(y, dtype=float)-self.ymin) / self._ystep
+		i  = np.clip(np.floor(ix).astype(int), 0, int(self.xn)-2)
+		j  = np.clip(np.floor(jy).astype(int), 0, int(self.yn)-2)
+
+		a  = ix - i
+		b  = jy - j
+		a1 = 1.0 - a
+		b1 = 1.0 - b
+
+		return a1*b1 * Z[j,i]   + \
+		       a1*b  * Z[j+1,i] + \
+		       a *b1 * Z[j,i+1] + \
+		       a *b  * Z[j+1,i+1]
+
+	#----------------------------------------------------------------------
+	# Return the parameters t (0<t<1) where the moves u1->u2 cross the
+	# interior grid lines 1..n-2, together with the move index of each.
+	# The outer cells are extrapolated linearly, so no split is needed there
+	#----------------------------------------------------------------------
+	@staticmethod
+	def _gridCrossings(u1, u2, n):
+		lo = np.floor(np.minimum(u1,u2)) + 1.0
+		hi = np.ceil(np.maximum(u1,u2))  - 1.0
+		lo = np.maximum(lo, 1.0)
+		hi = np.minimum(hi, float(n-2))
+		count = np.maximum(hi-lo+1.0, 0.0).astype(int)
+		total = count.sum()
+		if total == 0:
+			return np.zeros(0), np.zeros(0, dtype=int)
+		seg = np.repeat(np.arange(len(u1)), count)
+		first = np.cumsum(count) - count
+		k = lo[seg] + (np.arange(total) - first[seg])
+		return (k-u1[seg]) / (u2[seg]-u1[seg]), seg
+
+	#----------------------------------------------------------------------
+	# Batch version of splitLine() for a list of moves (x1,y1,z1,x2,y2,z2)
+	# return (xyz, index) where xyz is an array with the corrected end
+	# points of all moves and the points of move k are xyz[index[k]:index[k+1]]
+	#----------------------------------------------------------------------
+	def splitLines(self, segments):
+		seg = np.asarray(segments, dtype=float).reshape(-1,6)
+		x1, y1, z1, x2, y2, z2 = seg.T
+		n = len(seg)
+
+		if self.activePlane() is not None:
+			# planar correction is linear, the end points are enough
+			tx = ty = np.zeros(0)
+			sx = sy = np.zeros(0, dtype=int)
+		else:
+			tx, sx = self._gridCrossings((x1-self.xmin)/self._xstep,
+					(x2-self.xmin)/self._xstep, int(self.xn))
+			ty, sy = self._gridCrossings((y1-self.ymin)/self._ystep,
+					(y2-self.ymin)/self._ystep, int(self.yn))
+
+		t = np.concatenate((tx, ty, np.ones(n)))
+		s = np.concatenate((sx, sy, np.arange(n)))
+		order = np.lexsort((t, s))
+		t = t[order]
+		s = s[order]
+
+		# drop double points where the move crosses a grid node
+		keep = np.ones(len(t), dtype=bool)
+		keep[1:] = (s[1:]!=s[:-1]) | (t[1:]-t[:-1] > 1e-10)
+		t = t[keep]
+		s = s[keep]
+
+		x = x1[s] + t*(x2-x1)[s]
+		y = y1[s] + t*(y2-y1)[s]
+		z = z1[s] + t*(z2-z1)[s] + self.interpolateArray(x,y)
+
+		if self.tolerance > 0.0:
+			zs = z1 + self.interpolateArray(x1,y1)
+			keep = self._simplify(t, z, s, zs[s], np.bincount(s, minlength=n))
+			x = x[keep]
+			y = y[keep]
+			z = z[keep]
+			s = s[keep]
+
+		index = np.zeros(n+1, dtype=int)
+		index[1:] = np.cumsum(np.bincount(s, minlength=n))
+		return np.column_stack((x,y,z)), index
+
+	#----------------------------------------------------------------------
+	# Remove the break points of the moves where the corrected Z deviates
+	# less than tolerance from the chord between the kept neighbours.
+	# t,z are the parameters and corrected Z of the points sorted per move
+	# s, zs the corrected Z at the start of each point's move and count
+	# the number of points of each move. Return a mask of points to keep
+	#----------------------------------------------------------------------
+	def _simplify(self, t, z, s, zs, count):
+		keep = np.ones(len(t), dtype=bool)
+		tol  = self.tolerance
+		first = np.cumsum(count) - count
+		for k in np.nonzero(count>1)[0].tolist():
+			lo = first[k]
+			hi = lo + count[k]
+			tt = [0.0] + t[lo:hi].tolist()
+			zz = [zs[lo]] + z[lo:hi].tolist()
+			a = 0			# anchor point
+			j = 2			# try a chord from a to j
+			while j < len(tt):
+				slope = (zz[j]-zz[a]) / (tt[j]-tt[a])
+				for m in range(a+1, j):
+					if abs(zz[a] + slope*(tt[m]-tt[a]) - zz[m]) > tol:
+						break
+				else:
+					keep[lo+j-2] = False	# point j-1 is on the chord
+					j += 1
+					continue
+				a = j-1		# keep the previous point as new anchor
+				j = a+2
+		return keep
+
 	#----------------------------------------------------------------------
 	# Split line into multiple segments correcting for Z if needed
 	# return only end points
@@ -237,6 +955,10 @@ class Probe:
 		#print "splitLine:",x1, y1, z1, x2, y2, z2
 		#import pdb
 		#pdb.set_trace()
+		if self.tolerance > 0.0 or self.activePlane() is not None:
+			xyz, index = self.splitLines([(x1, y1, z1, x2, y2, z2)])
+			return [tuple(p) for p in xyz.tolist()]
+
 		i1 = int(math.floor((x1-self.xmin) / self._xstep))
 		i2 = int(math.floor((x2-self.xmin) / self._xstep))
 
@@ -313,6 +1035,128 @@ class Probe:
 		#print "segments=",segments
 		return segments
 
+#==============================================================================
+# Height model from scattered probe points using inverse distance weighting
+# of the k nearest points. The points are indexed in square buckets sized
+# to hold about k points each, and searched in rings around the query
+#==============================================================================
+class ScatteredHeight:
+	def __init__(self, points, k=SCATTER_K, power=2.0):
+		self.points = [(float(p[0]),float(p[1]),float(p[2])) for p in points]
+		self.k      = min(k, len(self.points))
+		self.power  = power
+
+		xs = [p[0] for p in self.points]
+		ys = [p[1] for p in self.points]
+		self.xmin = min(xs)
+		self.ymin = min(ys)
+		area = max(max(xs)-self.xmin, 1e-6) * max(max(ys)-self.ymin, 1e-6)
+		self.cell = math.sqrt(area*self.k/len(self.points))
+
+		self.buckets = {}
+		for p in self.points:
+			self.buckets.setdefault(self.bucket(p[0],p[1]),[]).append(p)
+		self.rmax = max([max(abs(i),abs(j)) for i,j in self.buckets])
+
+	#----------------------------------------------------------------------
+	def bucket(self, x, y):
+		return int(math.floor((x-self.xmin)/self.cell)), \
+		       int(math.floor((y-self.ymin)/self.cell))
+
+	#----------------------------------------------------------------------
+	# Return the k nearest points as a sorted list of (distance^2, point)
+	#----------------------------------------------------------------------
+	def nearest(self, x, y):
+		bi, bj = self.bucket(x,y)
+		found = []
+		r = 0
+		while True:
+			for i in range(bi-r, bi+r+1):
+				for j in range(bj-r, bj+r+1):
+					if max(abs(i-bi),abs(j-bj)) != r: continue
+					for p in self.buckets.get((i,j),()):
+						found.append(((p[0]-x)**2 + (p[1]-y)**2, p))
+			# all points outside the rings searched are further than r*cell
+			if len(found) >= self.k:
+				found.sort()
+				if found[self.k-1][0] <= (r*self.cell)**2: break
+			if r > self.rmax + abs(bi) + abs(bj): break
+			r += 1
+		found.sort()
+		return found[:self.k]
+
+	#----------------------------------------------------------------------
+	# Interpolated Z at x,y
+	#----------------------------------------------------------------------
+	def __call__(self, x, y):
+		sw = sz = 0.0
+		for d2, p in self.nearest(x,y):
+			if d2 < 1e-12: return p[2]
+			w = d2 ** (-0.5*self.power)
+			sw += w
+			sz += w*p[2]
+		return sz/sw
+
+#==============================================================================
+# Cache of autoleveled files. Each file is stored under a content key (see
+# GCode.levelKey) and the least recently used are removed once the
+# directory grows above size bytes
+#==============================================================================
+class LevelCache:
+	def __init__(self, path, size=LEVEL_CACHE):
+		self.path = path
+		self.size = size
+
+	#----------------------------------------------------------------------
+	def filename(self, key):
+		return os.path.join(self.path, "%s.gcode"%(key))
+
+	#----------------------------------------------------------------------
+	# Return the cached file for key or None
+	#----------------------------------------------------------------------
+	def get(self, key):
+		filename = self.filename(key)
+		try:
+			os.utime(filename, None)	# mark as recently used
+		except OSError:
+			return None
+		return filename
+
+	#----------------------------------------------------------------------
+	# Store a copy of filename under key and return the cached file
+	#----------------------------------------------------------------------
+	def put(self, key, filename):
+		if not os.path.isdir(self.path):
+			os.makedirs(self.path)
+		cached = self.filename(key)
+		shutil.copyfile(filename, cached+".tmp")
+		os.rename(cached+".tmp", cached)
+		self.evict(cached)
+		return cached
+
+	#----------------------------------------------------------------------
+	# Remove the least recently used files until the total size fits,
+	# always keeping the file keep
+	#----------------------------------------------------------------------
+	def evict(self, keep=None):
+		files = []
+		total = 0
+		for name in os.listdir(self.path):
+			if not name.endswith(".gcode"): continue
+			filename = os.path.join(self.path, name)
+			st = os.stat(filename)
+			files.append((st[ST_MTIME], st[ST_SIZE], filename))
+			total += st[ST_SIZE]
+		files.sort()
+		for mtime, size, filename in files:
+			if total <= self.size: break
+			if filename == keep: continue
+			try:
+				os.remove(filename)
+				total -= size
+			except OSError:
+				pass
+
 #==============================================================================
 # Command operations on a CNC
 #==============================================================================
@@ -384,6 +1228,7 @@ class CNC:
 		self.dx   = self.dy   = self.dz   = 0.0
 		self.di   = self.dj   = self.dk   = 0.0
 		self.rval = 0.0
+		self.center = None	# arc center of the last motionPath()
 		self.pval = 0.0
 		self.unit = 1.0
 
@@ -395,6 +1240,21 @@ class CNC:
 		self.feed        = 0
 		self.totalLength = 0.0
 		self.totalTime   = 0.0
+		self.rapidTime   = 0.0	# part of totalTime in rapid motions
+
+	#----------------------------------------------------------------------
+	# Modal state needed to continue processing from a given line
+	#----------------------------------------------------------------------
+	_STATE = ("x", "y", "z", "xval", "yval", "zval",
+		  "ival", "jval", "kval", "rval", "pval",
+		  "unit", "absolute", "gcode", "feed")
+
+	def getState(self):
+		return tuple([getattr(self,name) for name in CNC._STATE])
+
+	def setState(self, state):
+		for name,value in zip(CNC._STATE, state):
+			setattr(self, name, value)
 
 	#----------------------------------------------------------------------
 	def isMarginValid(self):
@@ -413,45 +1273,55 @@ class CNC:
 	# @return line in broken a list of commands, None if empty or comment
 	#----------------------------------------------------------------------
 	def parseLine(self, line):
-		while True:	# repeatedly remove parenthesis
-			pat = PARENPAT.match(line)
-			if pat:
-				line = pat.group(1) + pat.group(3)
-			else:
-				break
+		words = self.parseWords(line)
+		if words is None: return None
+		return [w[2] for w in words]
+
+	#----------------------------------------------------------------------
+	# Single pass tokenizer
+	# @return list of (LETTER, value, text) words, None if empty or comment
+	# where text is the original word as written (spaces removed)
+	#----------------------------------------------------------------------
+	@staticmethod
+	def parseWords(line):
+		if "(" in line: line = COMMENTPAT.sub("", line)
 
 		# skip empty lines
 		if len(line)==0 or line[0] in ("%","(","#",";"):
 			return None
+		if ";" in line: line = line[:line.index(";")]
 
-		# process command
-		# strip all spaces
-		line = line.replace(" ","")
-
-		# break line into tokens
-		#cmd = []
-		#for ch in line:
-		#
-
-		# Insert space before each command
-		line = re.sub(CMDPAT,r" \1",line).lstrip()
-		return line.split()
+		words = []
+		for c,v in WORDPAT.findall(line.replace(" ","")):
+			try:
+				value = float(v)
+			except ValueError:
+				value = 0.0
+			words.append((c.upper(), value, c+v))
+		return words
 
 	#----------------------------------------------------------------------
 	# Create path for one g command
 	#----------------------------------------------------------------------
 	def processPath(self, cmds):
+		words = []
 		for cmd in cmds:
-			c = cmd[0].upper()
 			try:
 				value = float(cmd[1:])
 			except:
 				value = 0
+			words.append((cmd[0].upper(), value, cmd))
+		self.processWords(words)
 
+	#----------------------------------------------------------------------
+	# Create path for one g command from parsed words
+	#----------------------------------------------------------------------
+	def processWords(self, words):
+		for c,value,cmd in words:
 			if   c == "X":
 				self.xval = value*self.unit
 				if not self.absolute:
-					self.xval += x
+					self.xval += self.x
 
 			elif c == "Y":
 				self.yval = value*self.unit
@@ -548,7 +1418,7 @@ class CNC:
 	#----------------------------------------------------------------------
 	# Create path for one g command
 	#----------------------------------------------------------------------
-	def motionPath(self):
+	def motionPath(self, flatten=True):
 		xyz = []
 
 		# Execute g-code
@@ -561,7 +1431,7 @@ class CNC:
 
 		elif self.gcode in (2,3):	# CW=2,CCW=3 circle
 			xyz.append((self.x,self.y,self.z))
-			xc,yc,zc = self.motionCenter()
+			xc,yc,zc = self.center = self.motionCenter()
 #			if self.rval>0.0:
 #				ABx = self.xval-self.x
 #				ABy = self.yval-self.y
@@ -589,42 +1459,79 @@ class CNC:
 #				#if abs((self.rval-r2)/self.rval) > 0.01:
 #				#	print>>sys.stderr, "ERROR arc", r2, self.rval
 
-			phi  = math.atan2(self.y-yc, self.x-xc)
-			ephi = math.atan2(self.yval-yc, self.xval-xc)
-			try:
-				sagitta = 1.0-self.accuracy/self.rval
-			except ZeroDivisionError:
-				sagitta = 0.0
-			if sagitta>0.0:
-				df = 2.0*math.acos(sagitta)
-				df = min(df, math.pi/4.0)
-			else:
-				df = math.pi/4.0
-
-			if self.gcode==2:
-				if ephi>=phi-1e-10: ephi -= 2.0*math.pi
-				phi -= df
-				while phi>ephi:
-					self.x = xc + self.rval*math.cos(phi)
-					self.y = yc + self.rval*math.sin(phi)
-					phi -= df
-					xyz.append((self.x,self.y,self.z))
-			else:
-				if ephi<=phi+1e-10: ephi += 2.0*math.pi
-				phi += df
-				while phi<ephi:
-					self.x = xc + self.rval*math.cos(phi)
-					self.y = yc + self.rval*math.sin(phi)
-					phi += df
-					xyz.append((self.x,self.y,self.z))
+			# unflattened arc: only start and end, use arcAngles()
+			if flatten:
+				phi, ephi = self.arcAngles(xc, yc)
+				df = self.arcStep(self.rval)
+				n  = int(math.ceil(abs(ephi-phi)/df))-1
+				if self.gcode==2: df = -df
+				self.arcPoints(xyz, xc, yc, phi, df, n)
 
 			xyz.append((self.xval,self.yval,self.zval))
 
 		elif self.gcode==4:	# Dwell
-			self.totalTime = self.pval
+			self.totalTime += self.pval
 
 		return xyz
 
+	#----------------------------------------------------------------------
+	# @return start and end angle of the arc motion around xc,yc
+	# decreasing for CW (G2) and increasing for CCW (G3)
+	#----------------------------------------------------------------------
+	def arcAngles(self, xc, yc):
+		phi  = math.atan2(self.y-yc, self.x-xc)
+		ephi = math.atan2(self.yval-yc, self.xval-xc)
+		if self.gcode==2:
+			if ephi>=phi-1e-10: ephi -= 2.0*math.pi
+		else:
+			if ephi<=phi+1e-10: ephi += 2.0*math.pi
+		return phi, ephi
+
+	#----------------------------------------------------------------------
+	# @return angle step to linearize an arc of radius r within accuracy
+	#----------------------------------------------------------------------
+	_arcSteps = {}
+	def arcStep(self, r):
+		key = (r, self.accuracy)
+		try:
+			return CNC._arcSteps[key]
+		except KeyError:
+			pass
+		try:
+			sagitta = 1.0-self.accuracy/r
+		except ZeroDivisionError:
+			sagitta = 0.0
+		if sagitta>0.0:
+			df = min(2.0*math.acos(sagitta), math.pi/4.0)
+		else:
+			df = math.pi/4.0
+		if len(CNC._arcSteps) >= ARC_STEPS: CNC._arcSteps.clear()
+		CNC._arcSteps[key] = df
+		return df
+
+	#----------------------------------------------------------------------
+	# Append to xyz the n points of the arc at angles phi+k*df, k=1..n
+	# rotating the radius vector, or with numpy for long arcs
+	# Leaves self.x, self.y on the last point
+	#----------------------------------------------------------------------
+	def arcPoints(self, xyz, xc, yc, phi, df, n):
+		if n<=0: return
+		r = self.rval
+		z = self.z
+		if n < ARC_NUMPY:
+			c  = math.cos(df)
+			s  = math.sin(df)
+			dx = r*math.cos(phi)
+			dy = r*math.sin(phi)
+			for k in xrange(n):
+				dx, dy = dx*c - dy*s, dx*s + dy*c
+				xyz.append((xc+dx, yc+dy, z))
+		else:
+			f = phi + df*np.arange(1, n+1)
+			xyz.extend(zip((xc + r*np.cos(f)).tolist(),
+				       (yc + r*np.sin(f)).tolist(), [z]*n))
+		self.x, self.y, z = xyz[-1]
+
 	#----------------------------------------------------------------------
 	# move to end position
 	#----------------------------------------------------------------------
@@ -644,17 +1551,24 @@ class CNC:
 
 	#----------------------------------------------------------------------
 	def pathLength(self, xyz):
-		# For XY plan
-		p = xyz[0]
-		length = 0.0
-		for i in xyz:
-			length += math.sqrt((i[0]-p[0])**2 + (i[1]-p[1])**2 + (i[2]-p[2])**2)
-			p = i
+		if self.gcode in (2,3) and len(xyz)==2:
+			# unflattened arc, center and radius found by motionPath()
+			xc,yc,zc = self.center
+			phi, ephi = self.arcAngles(xc, yc)
+			length = math.hypot(self.rval*(ephi-phi), self.zval-self.z)
+		else:
+			# For XY plan
+			p = xyz[0]
+			length = 0.0
+			for i in xyz:
+				length += math.sqrt((i[0]-p[0])**2 + (i[1]-p[1])**2 + (i[2]-p[2])**2)
+				p = i
 
 		self.totalLength += length
 		if self.gcode == 0:
 			# FIXME calculate the correct time with the feed direction
 			self.totalTime += length / self.feedmax_x
+			self.rapidTime += length / self.feedmax_x
 		else:
 			try:
 				self.totalTime += length / self.feed
@@ -664,6 +1578,19 @@ class CNC:
 
 	#----------------------------------------------------------------------
 	def pathMargins(self, xyz):
+		if self.gcode in (2,3) and len(xyz)==2:
+			# unflattened arc, add the quadrant points in the sweep
+			xc,yc,zc = self.center
+			phi, ephi = self.arcAngles(xc, yc)
+			lo, hi = min(phi,ephi), max(phi,ephi)
+			k = math.ceil(lo/(math.pi/2.0))
+			xyz = list(xyz)
+			while k*math.pi/2.0 < hi:
+				f = k*math.pi/2.0
+				xyz.append((xc+self.rval*math.cos(f),
+					    yc+self.rval*math.sin(f), self.z))
+				k += 1
+
 		if self.gcode in (1,2,3):
 			self.xmin = min(self.xmin,min([i[0] for i in xyz]))
 			self.ymin = min(self.ymin,min([i[1] for i in xyz]))
@@ -672,6 +1599,58 @@ class CNC:
 			self.ymax = max(self.ymax,max([i[1] for i in xyz]))
 			self.zmax = max(self.zmax,max([i[2] for i in xyz]))
 
+#==============================================================================
+# Path length, cutting and rapid time, margins of the cutting motions and
+# exit position of a block or of a whole program
+#==============================================================================
+class PathStats:
+	def __init__(self):
+		self.length    = 0.0
+		self.cutTime   = 0.0
+		self.rapidTime = 0.0
+		self.xmin = self.ymin = self.zmin =  1000000.0
+		self.xmax = self.ymax = self.zmax = -1000000.0
+		self.x = self.y = self.z = 0.0
+
+	#----------------------------------------------------------------------
+	# Statistics accumulated by cnc since the last initPath()
+	#----------------------------------------------------------------------
+	@staticmethod
+	def fromCNC(cnc):
+		stats = PathStats()
+		stats.length    = cnc.totalLength
+		stats.cutTime   = cnc.totalTime - cnc.rapidTime
+		stats.rapidTime = cnc.rapidTime
+		stats.xmin, stats.ymin, stats.zmin = cnc.xmin, cnc.ymin, cnc.zmin
+		stats.xmax, stats.ymax, stats.zmax = cnc.xmax, cnc.ymax, cnc.zmax
+		stats.x, stats.y, stats.z = cnc.x, cnc.y, cnc.z
+		return stats
+
+	#----------------------------------------------------------------------
+	def time(self):
+		return self.cutTime + self.rapidTime
+
+	#----------------------------------------------------------------------
+	def isMarginValid(self):
+		return	self.xmin < self.xmax and \
+			self.ymin < self.ymax and \
+			self.zmin < self.zmax
+
+	#----------------------------------------------------------------------
+	# Append the statistics of the following block
+	#----------------------------------------------------------------------
+	def add(self, stats):
+		self.length    += stats.length
+		self.cutTime   += stats.cutTime
+		self.rapidTime += stats.rapidTime
+		self.xmin = min(self.xmin, stats.xmin)
+		self.ymin = min(self.ymin, stats.ymin)
+		self.zmin = min(self.zmin, stats.zmin)
+		self.xmax = max(self.xmax, stats.xmax)
+		self.ymax = max(self.ymax, stats.ymax)
+		self.zmax = max(self.zmax, stats.zmax)
+		self.x, self.y, self.z = stats.x, stats.y, stats.z
+
 #==============================================================================
 # Block of g-code commands. A gcode file is represented as a list of blocks
 # - Commands are grouped as (non motion commands Mxxx)
@@ -693,6 +1672,11 @@ class Block(list):
 		self._path   = []	# canvas drawing paths
 		self.x = self.y = self.z = 0	# ending coordinates
 
+		self._words  = None	# cached parsed words of each line
+		self._entry  = None	# cnc state the cached exit state starts from
+		self._exit   = None	# cached cnc state after the last line
+		self._stats  = None	# cached PathStats from the _entry state
+
 	#----------------------------------------------------------------------
 	def name(self):
 		return self._name is None and "block" or self._name
@@ -714,6 +1698,17 @@ class Block(list):
 
 	#----------------------------------------------------------------------
 	def append(self, line):
+		if self._attribute(line): return
+		list.append(self, line)
+		if self._words is not None: self._words.append(False)
+		self._exit  = None
+		self._stats = None
+
+	#----------------------------------------------------------------------
+	# Set the block attributes from the (Block-...) and id: comments
+	# @return True if line is an attribute and not part of the block
+	#----------------------------------------------------------------------
+	def _attribute(self, line):
 		if line.startswith("(Block-"):
 			pat = BLOCKPAT.match(line)
 			if pat:
@@ -721,17 +1716,151 @@ class Block(list):
 				value = value.strip()
 				if name=="name":
 					self._name = value
-					return
+					return True
 				elif name=="expand":
 					self.expand = bool(int(value))
-					return
+					return True
 				elif name=="visible":
 					self.visible = bool(int(value))
-					return
+					return True
 		if self._name is None and ("id:" in line) and ("End" not in line):
 			pat = IDPAT.match(line)
 			if pat: self._name = pat.group(1)
-		list.append(self, line)
+		return False
+
+	#----------------------------------------------------------------------
+	# Append a line together with its already parsed words
+	#----------------------------------------------------------------------
+	def appendWords(self, line, words):
+		n = len(self)
+		self.append(line)
+		if len(self) == n: return	# block attribute
+		if self._words is None:
+			self._words = [False]*n
+			self._words.append(words)
+		else:
+			self._words[-1] = words
+
+	#----------------------------------------------------------------------
+	# @return parsed words of line i as CNC.parseWords(), parsing it only
+	# the first time it is requested after a change
+	#----------------------------------------------------------------------
+	def words(self, i):
+		if self._words is None: self._words = [False]*len(self)
+		words = self._words[i]
+		if words is False:
+			words = self._words[i] = CNC.parseWords(self[i])
+		return words
+
+	#----------------------------------------------------------------------
+	# Advance cnc from its current state to the state after the last line
+	# of the block. The exit state is remembered for the entry state used
+	# @return exit state
+	#----------------------------------------------------------------------
+	def exitState(self, cnc):
+		entry = cnc.getState()
+		if self._exit is not None and self._entry == entry:
+			cnc.setState(self._exit)
+		else:
+			for i in range(len(self)):
+				words = self.words(i)
+				if words is None: continue
+				cnc.processWords(words)
+				cnc.motionPathEnd()
+			self._entry = entry
+			self._exit  = cnc.getState()
+			self._stats = None
+		self.x = cnc.x
+		self.y = cnc.y
+		self.z = cnc.z
+		return self._exit
+
+	#----------------------------------------------------------------------
+	# Advance cnc to the exit state like exitState()
+	# @return PathStats of the block for the current cnc state, they are
+	# calculated only after the block or the entry state changed
+	#----------------------------------------------------------------------
+	def stats(self, cnc):
+		entry = cnc.getState()
+		if self._stats is not None and self._entry == entry:
+			cnc.setState(self._exit)
+			return self._stats
+
+		cnc.initPath(cnc.x, cnc.y, cnc.z)
+		cnc.setState(entry)
+		for i in range(len(self)):
+			words = self.words(i)
+			if words is None: continue
+			cnc.processWords(words)
+			xyz = cnc.motionPath(False)
+			if xyz:
+				cnc.pathLength(xyz)
+				cnc.pathMargins(xyz)
+			cnc.motionPathEnd()
+		self._entry = entry
+		self._exit  = cnc.getState()
+		self._stats = PathStats.fromCNC(cnc)
+		return self._stats
+
+	#----------------------------------------------------------------------
+	# Forget the cached information of line i or of all lines
+	#----------------------------------------------------------------------
+	def _changed(self, i=None):
+		if isinstance(i,int) and self._words is not None:
+			self._words[i] = False
+		else:
+			self._words = None
+		self._exit  = None
+		self._stats = None
+
+	#----------------------------------------------------------------------
+	# Every modification of the lines invalidates the cache
+	#----------------------------------------------------------------------
+	def __setitem__(self, i, line):
+		list.__setitem__(self, i, line)
+		self._changed(i)
+
+	def __delitem__(self, i):
+		list.__delitem__(self, i)
+		self._changed()
+
+	def __setslice__(self, i, j, lines):
+		list.__setslice__(self, i, j, lines)
+		self._changed()
+
+	def __delslice__(self, i, j):
+		list.__delslice__(self, i, j)
+		self._changed()
+
+	def __iadd__(self, lines):
+		list.extend(self, lines)
+		self._changed()
+		return self
+
+	def insert(self, i, line):
+		list.insert(self, i, line)
+		self._changed()
+
+	def extend(self, lines):
+		list.extend(self, lines)
+		self._changed()
+
+	def pop(self, i=-1):
+		line = list.pop(self, i)
+		self._changed()
+		return line
+
+	def remove(self, line):
+		list.remove(self, line)
+		self._changed()
+
+	def reverse(self):
+		list.reverse(self)
+		self._changed()
+
+	def sort(self, *args, **kwargs):
+		list.sort(self, *args, **kwargs)
+		self._changed()
 
 	#----------------------------------------------------------------------
 	def addPath(self, p):
@@ -747,6 +1876,357 @@ class Block(list):
 	def resetPath(self):
 		del self._path[:]
 
+#==============================================================================
+# Compact block storing each line as its G code followed by the X,Y,Z,I,J,F
+# values in one typed array, about 30 bytes per line instead of a python
+# string. Lines that cannot be stored exactly (comments, other words, more
+# than four decimals...) are kept as text. The text of the packed lines is
+# recreated when accessed, normalized as "G1 X10.5 Y2"
+#==============================================================================
+class PackedBlock(object):
+	# no instance dictionary, large jobs have many thousands of blocks
+	__slots__ = ("_name", "visible", "expand", "_path", "x", "y", "z",
+		     "_data", "_text", "_entry", "_exit", "_stats")
+
+	STRIDE = len(PACKED)+1	# G code followed by the PACKED values
+
+	def __init__(self, name=None):
+		self._name   = name
+		self.visible = True	# Visible in drawing
+		self.expand  = False	# Expand in editor
+
+		self._path   = []	# canvas drawing paths
+		self.x = self.y = self.z = 0	# ending coordinates
+
+		self._data   = array("i")	# STRIDE integers per line
+		self._text   = None	# lines kept as text {index:line}
+		self._entry  = None	# cnc state the cached exit state starts from
+		self._exit   = None	# cached cnc state after the last line
+		self._stats  = None	# cached PathStats from the _entry state
+
+	#----------------------------------------------------------------------
+	def name(self):
+		return self._name is None and "block" or self._name
+
+	#----------------------------------------------------------------------
+	def header(self):
+		return Block.header.im_func(self)
+
+	#----------------------------------------------------------------------
+	def write(self, f):
+		f.write("(Block-name: %s)\n"%(self.name()))
+		f.write("(Block-expand: %d)\n"%(int(self.expand)))
+		f.write("(Block-visible: %d)\n"%(int(self.visible)))
+		for line in self:
+			f.write("%s\n"%(line))
+
+	#----------------------------------------------------------------------
+	def _changed(self):
+		self._exit  = None
+		self._stats = None
+
+	#----------------------------------------------------------------------
+	# @return the STRIDE integers of a line with words if it can be packed
+	#	  else None
+	#----------------------------------------------------------------------
+	@staticmethod
+	def pack(words):
+		row = [-1] + [PACKED_NONE]*len(PACKED)
+		for c,value,cmd in words:
+			if c == "G":
+				if row[0] != -1 or value != int(value) or \
+				   not 0 <= value < 128:
+					return None
+				row[0] = int(value)
+				continue
+			i = PACKED.find(c)+1
+			if i==0 or row[i] != PACKED_NONE: return None
+			n = int(round(value*PACKED_SCALE))
+			if abs(n) >= 2**31-1 or abs(n-value*PACKED_SCALE) > 1e-6:
+				return None
+			row[i] = n
+		return row
+
+	#----------------------------------------------------------------------
+	# Fixed point number n as text
+	#----------------------------------------------------------------------
+	@staticmethod
+	def number(n):
+		sign = n<0 and "-" or ""
+		i,f = divmod(abs(n), PACKED_SCALE)
+		if f == 0: return "%s%d"%(sign,i)
+		return ("%s%d.%04d"%(sign,i,f)).rstrip("0")
+
+	#----------------------------------------------------------------------
+	# @return the STRIDE integers of line, keeping it as text at position i
+	# when it cannot be packed
+	#----------------------------------------------------------------------
+	def _row(self, i, line, words=False):
+		row = None
+		if "(" not in line and ";" not in line:
+			if words is False: words = CNC.parseWords(line)
+			if words: row = PackedBlock.pack(words)
+		if row is None:
+			if self._text is None: self._text = {}
+			self._text[i] = line
+			row = [PACKED_TEXT] + [PACKED_NONE]*len(PACKED)
+		return array("i", row)
+
+	#----------------------------------------------------------------------
+	# Move the text lines from position i by n
+	#----------------------------------------------------------------------
+	def _shift(self, i, n):
+		if not self._text: return
+		text = {}
+		for j,line in self._text.items():
+			if j >= i: j += n
+			text[j] = line
+		self._text = text
+
+	#----------------------------------------------------------------------
+	def _insert(self, i, line, words=False):
+		if i < len(self): self._shift(i, 1)
+		k = i*PackedBlock.STRIDE
+		self._data[k:k] = self._row(i, line, words)
+		self._changed()
+
+	#----------------------------------------------------------------------
+	def append(self, line):
+		self.appendWords(line, False)
+
+	#----------------------------------------------------------------------
+	def appendWords(self, line, words):
+		if Block._attribute.im_func(self, line): return
+		self._data.extend(self._row(len(self), line, words))
+		self._changed()
+
+	#----------------------------------------------------------------------
+	def insert(self, i, line):
+		if i < 0: i = max(0, i+len(self))
+		self._insert(min(i,len(self)), line)
+
+	#----------------------------------------------------------------------
+	def extend(self, lines):
+		for line in lines: self.appendWords(line, False)
+
+	#----------------------------------------------------------------------
+	# @return parsed words of line i as CNC.parseWords()
+	#----------------------------------------------------------------------
+	def words(self, i):
+		if i<0: i += len(self)
+		k = i*PackedBlock.STRIDE
+		code = self._data[k]
+		if code == PACKED_TEXT:
+			return CNC.parseWords(self._text[i])
+		words = []
+		if code >= 0:
+			words.append(("G", float(code), "G%d"%(code)))
+		for c in PACKED:
+			k += 1
+			n = self._data[k]
+			if n != PACKED_NONE:
+				words.append((c, float(n)/PACKED_SCALE,
+					c+PackedBlock.number(n)))
+		return words
+
+	#----------------------------------------------------------------------
+	def exitState(self, cnc):
+		return Block.exitState.im_func(self, cnc)
+
+	#----------------------------------------------------------------------
+	def stats(self, cnc):
+		return Block.stats.im_func(self, cnc)
+
+	#----------------------------------------------------------------------
+	def __len__(self):
+		return len(self._data)//PackedBlock.STRIDE
+
+	def __iter__(self):
+		for i in xrange(len(self)):
+			yield self[i]
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self[j] for j in xrange(*i.indices(len(self)))]
+		if i<0: i += len(self)
+		if self._data[i*PackedBlock.STRIDE] == PACKED_TEXT:
+			return self._text[i]
+		return " ".join([w[2] for w in self.words(i)])
+
+	def __setitem__(self, i, line):
+		if isinstance(i, slice):
+			self.__delitem__(i)
+			start = i.indices(len(self))[0]
+			for j,line in enumerate(line):
+				self._insert(start+j, line)
+			return
+		if i<0: i += len(self)
+		if self._text: self._text.pop(i, None)
+		k = i*PackedBlock.STRIDE
+		self._data[k:k+PackedBlock.STRIDE] = self._row(i, line)
+		self._changed()
+
+	def __delitem__(self, i):
+		if isinstance(i, slice):
+			for j in reversed(xrange(*i.indices(len(self)))):
+				del self[j]
+			return
+		if i<0: i += len(self)
+		k = i*PackedBlock.STRIDE
+		del self._data[k:k+PackedBlock.STRIDE]
+		if self._text:
+			self._text.pop(i, None)
+			if i < len(self): self._shift(i+1, -1)
+		self._changed()
+
+	def __getslice__(self, i, j):
+		return self[max(0,i):max(0,j):]
+
+	def __setslice__(self, i, j, lines):
+		self[max(0,i):max(0,j):] = lines
+
+	def __delslice__(self, i, j):
+		del self[max(0,i):max(0,j):]
+
+	#----------------------------------------------------------------------
+	def pop(self, i=-1):
+		line = self[i]
+		del self[i]
+		return line
+
+	#----------------------------------------------------------------------
+	def addPath(self, p):
+		self._path.append(p)
+
+	#----------------------------------------------------------------------
+	def endPath(self, x, y, z):
+		self.x = x
+		self.y = y
+		self.z = z
+
+	#----------------------------------------------------------------------
+	def resetPath(self):
+		del self._path[:]
+
+#==============================================================================
+# Block of a lazily loaded file. Only the byte range of the block in the
+# memory mapped file is known, the lines are read into a Block (or
+# PackedBlock) when first accessed. Unmodified blocks can be released again
+#==============================================================================
+class LazyBlock(object):
+	__slots__ = ("_name", "visible", "expand", "_mmap", "_start", "_end",
+		     "_count", "_packed", "_block", "_keep",
+		     "_entry", "_exit", "_stats")
+
+	def __init__(self, name, mm, start, packed=False):
+		self._name   = name
+		self.visible = True	# Visible in drawing
+		self.expand  = False	# Expand in editor
+
+		self._mmap   = mm	# memory mapped file
+		self._start  = start	# byte range of the block lines
+		self._end    = start
+		self._count  = 0	# number of lines
+		self._packed = packed	# materialize as PackedBlock
+		self._block  = None	# materialized block
+		self._keep   = False	# block was modified, do not release it
+		self._entry  = None	# statistics kept also when released
+		self._exit   = None
+		self._stats  = None
+
+	#----------------------------------------------------------------------
+	def name(self):
+		return self._name is None and "block" or self._name
+
+	#----------------------------------------------------------------------
+	def header(self):
+		return Block.header.im_func(self)
+
+	#----------------------------------------------------------------------
+	# @return the materialized block, reading its lines if needed
+	#----------------------------------------------------------------------
+	def block(self):
+		if self._block is None:
+			if self._packed:
+				block = PackedBlock(self._name)
+			else:
+				block = Block(self._name)
+			data = self._mmap[self._start:self._end]
+			if data.endswith("\n"): data = data[:-1]
+			if data or self._count:
+				for line in data.split("\n"):
+					block.append(line.replace("\x0d",""))
+			self._block = block
+		return self._block
+
+	#----------------------------------------------------------------------
+	# Forget the lines if they were not modified
+	#----------------------------------------------------------------------
+	def release(self):
+		if not self._keep: self._block = None
+
+	#----------------------------------------------------------------------
+	# @return block to be modified
+	#----------------------------------------------------------------------
+	def _modify(self):
+		self._keep  = True
+		self._stats = None
+		return self.block()
+
+	#----------------------------------------------------------------------
+	def write(self, f):
+		f.write("(Block-name: %s)\n"%(self.name()))
+		f.write("(Block-expand: %d)\n"%(int(self.expand)))
+		f.write("(Block-visible: %d)\n"%(int(self.visible)))
+		for line in self:
+			f.write("%s\n"%(line))
+
+	#----------------------------------------------------------------------
+	def words(self, i):		return self.block().words(i)
+	def exitState(self, cnc):	return self.block().exitState(cnc)
+
+	#----------------------------------------------------------------------
+	# Block statistics, without keeping the lines of an unloaded block
+	#----------------------------------------------------------------------
+	def stats(self, cnc):
+		entry = cnc.getState()
+		if self._stats is not None and self._entry == entry:
+			cnc.setState(self._exit)
+			return self._stats
+		loaded = self._block is not None
+		self._stats = self.block().stats(cnc)
+		self._entry = entry
+		self._exit  = cnc.getState()
+		if not loaded: self.release()
+		return self._stats
+
+	def append(self, line):		self._modify().append(line)
+	def appendWords(self, line, words):
+		self._modify().appendWords(line, words)
+	def insert(self, i, line):	self._modify().insert(i, line)
+	def extend(self, lines):	self._modify().extend(lines)
+	def pop(self, i=-1):		return self._modify().pop(i)
+
+	#----------------------------------------------------------------------
+	def __len__(self):
+		if self._block is None: return self._count
+		return len(self._block)
+
+	def __iter__(self):		return iter(self.block())
+	def __getitem__(self, i):	return self.block()[i]
+	def __getslice__(self, i, j):	return self.block()[i:j]
+
+	def __setitem__(self, i, line):	self._modify()[i] = line
+	def __delitem__(self, i):	del self._modify()[i]
+	def __setslice__(self, i, j, lines):
+		self._modify()[i:j] = lines
+	def __delslice__(self, i, j):	del self._modify()[i:j]
+
+	#----------------------------------------------------------------------
+	def addPath(self, p):		self.block().addPath(p)
+	def endPath(self, x, y, z):	self.block().endPath(x, y, z)
+	def resetPath(self):		self.block().resetPath()
+
 #==============================================================================
 # Gcode file
 #==============================================================================
@@ -758,6 +2238,7 @@ class GCode:
 		self.blocks   = []	# list of blocks
 		self.cnc      = CNC()
 		self.undoredo = undo.UndoRedo()
+		self.compact  = False	# load blocks as PackedBlock
 
 		self._lastModified = 0
 		self._modified = False
@@ -774,7 +2255,7 @@ class GCode:
 	#----------------------------------------------------------------------
 	# Load a file into editor
 	#----------------------------------------------------------------------
-	def load(self, filename=None):
+	def load(self, filename=None, lazy=False):
 		if filename is not None: self.filename = filename
 		try: f = open(self.filename,"r")
 		except: return False
@@ -790,13 +2271,107 @@ class GCode:
 		self.cnc.initPath()
 		del self.blocks[:]
 		self._lastComment = 0
-		for line in f:
-			self._addLine(line[:-1].replace("\x0d",""))
-		self._trim()
+		if lazy and os.fstat(f.fileno())[ST_SIZE] > 0:
+			self._scan(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+		else:
+			for line in f:
+				self._addLine(line[:-1].replace("\x0d",""))
+			self._trim()
 
 		f.close()
 		return True
 
+	#----------------------------------------------------------------------
+	# Split the memory mapped file into LazyBlocks with the same rules as
+	# _addLine(), tracking only the G,M,Z words that define the blocks
+	#----------------------------------------------------------------------
+	def _scan(self, mm):
+		cnc   = self.cnc
+		block = None
+		last  = 0	# offset of last line
+		empty = False	# last line of block is empty
+		fast  = False	# past the header and z is up to date
+		end   = 0
+		readline = mm.readline
+		while True:
+			start = end
+			line  = readline()
+			if not line: break
+			end  += len(line)
+			if line[-1]=="\n": line = line[:-1]
+			if "\x0d" in line: line = line.replace("\x0d","")
+
+			# lines that can only change the motion G code
+			if fast and "Z" not in line and "z" not in line and \
+			   "M" not in line and "m" not in line and \
+			   "(" not in line and ";" not in line and \
+			   "id:" not in line and line[:1] not in ("%","#"):
+				codes = GCODEPAT.findall(line)
+				if not codes or codes[-1] in MOTION:
+					if codes: cnc.gcode = int(codes[-1])
+					block._count += 1
+					last  = start
+					empty = len(line)==0
+					block._end = end
+					continue
+
+			if line.startswith("(Block-name:"):
+				pat = BLOCKPAT.match(line)
+				if pat:
+					value = pat.group(2).strip()
+					if block is None or block._count:
+						block = LazyBlock(value, mm, start, self.compact)
+						self.blocks.append(block)
+					else:
+						block._name = value
+					block._end = end
+					continue
+
+			if block is None:
+				block = LazyBlock("Header", mm, start, self.compact)
+				self.blocks.append(block)
+
+			rapid = False
+			if "(" in line: text = COMMENTPAT.sub("", line)
+			else: text = line
+			if len(text)>0 and text[0] not in ("%","(","#",";"):
+				if ";" in text: text = text[:text.index(";")]
+				words = []
+				for c,v in SCANPAT.findall(text.replace(" ","")):
+					try:
+						value = float(v)
+					except ValueError:
+						value = 0.0
+					words.append((c.upper(), value, c+v))
+				cnc.processWords(words)
+				cnc.motionPathEnd()
+				rapid = cnc.gcode == 0
+
+			# same block splitting as _addLine()
+			if rapid and cnc.dz <= 0.0 and len(self.blocks)==1:
+				block._end = start
+				block = LazyBlock(None, mm, start, self.compact)
+				self.blocks.append(block)
+
+			if ("(" not in line and "id:" not in line) or \
+			   not Block._attribute.im_func(block, line):
+				block._count += 1
+				last  = start
+				empty = len(line)==0
+			block._end = end
+
+			if rapid and cnc.dz > 0.0:
+				block = LazyBlock(None, mm, end, self.compact)
+				self.blocks.append(block)
+			fast = len(self.blocks)>1 and cnc.z == cnc.zval
+
+		# same as _trim()
+		if block._count==1 and empty:
+			block._count = 0
+			block._end   = last
+		if block._count==0:
+			self.blocks.pop()
+
 	#----------------------------------------------------------------------
 	# Save to a file
 	#----------------------------------------------------------------------
@@ -852,10 +2427,10 @@ class GCode:
 		dxf.writeHeader()
 		for block in self.blocks:
 			name = block.name()
-			for line in block:
-				cmds = self.cnc.parseLine(line)
-				if cmds is None: continue
-				self.cnc.processPath(cmds)
+			for i,line in enumerate(block):
+				words = block.words(i)
+				if words is None: continue
+				self.cnc.processWords(words)
 				if self.cnc.gcode == 1:	# line
 					dxf.line(self.cnc.x, self.cnc.y, self.cnc.xval, self.cnc.yval, name)
 				elif self.cnc.gcode in (2,3):	# arc
@@ -918,10 +2493,10 @@ class GCode:
 		path = Path(block.name())
 		self.initPath(bid)
 		start = Vector(self.cnc.x, self.cnc.y)
-		for line in block:
-			cmds = self.cnc.parseLine(line)
-			if cmds is None: continue
-			self.cnc.processPath(cmds)
+		for i,line in enumerate(block):
+			words = block.words(i)
+			if words is None: continue
+			self.cnc.processWords(words)
 			end = Vector(self.cnc.xval, self.cnc.yval)
 			if self.cnc.gcode == 0:		# rapid move (new block)
 				if path:
@@ -945,6 +2520,42 @@ class GCode:
 		if path: paths.append(path)
 		return paths
 
+	#----------------------------------------------------------------------
+	# Return the LevelCache key of the leveled output of filename with the
+	# current probe and cnc settings
+	#----------------------------------------------------------------------
+	def levelKey(self, filename=None):
+		if filename is None: filename = self.filename
+		h = hashlib.sha1()
+		f = open(filename,"rb")
+		while True:
+			data = f.read(1<<16)
+			if not data: break
+			h.update(data)
+		f.close()
+		h.update(self.probe.signature())
+		h.update("accuracy=%r decimal=%d"%(self.cnc.accuracy, self.cnc.decimal))
+		return h.hexdigest()
+
+	#----------------------------------------------------------------------
+	# Autolevel filename into output with the current probe, reusing the
+	# result stored in cache when nothing has changed since the last time
+	#----------------------------------------------------------------------
+	def level2File(self, filename, output, cache, processes=1):
+		key = self.levelKey(filename)
+		cached = cache.get(key)
+		if cached is not None:
+			shutil.copyfile(cached, output)
+			return True
+
+		probe = self.probe
+		self.probe = Probe()	# load() resets the probe
+		ok = self.load(filename, True)
+		self.probe = probe
+		if not ok or not self.save2Run(output, processes): return False
+		cache.put(key, output)
+		return True
+
 	#----------------------------------------------------------------------
 	# Check if a new version exists
 	#----------------------------------------------------------------------
@@ -957,6 +2568,13 @@ class GCode:
 	#----------------------------------------------------------------------
 	def fmt(self, c, v, d=None): return self.cnc.fmt(c,v,d)
 
+	#----------------------------------------------------------------------
+	# @return a new empty block of the type selected with compact
+	#----------------------------------------------------------------------
+	def newBlock(self, name=None):
+		if self.compact: return PackedBlock(name)
+		return Block(name)
+
 	#----------------------------------------------------------------------
 	# add new line to list create block if necessary
 	#----------------------------------------------------------------------
@@ -966,32 +2584,32 @@ class GCode:
 			if pat:
 				value = pat.group(2).strip()
 				if not self.blocks or len(self.blocks[-1]):
-					self.blocks.append(Block(value))
+					self.blocks.append(self.newBlock(value))
 				else:
 					self.blocks[-1]._name = value
 				return
 
 		if not self.blocks:
-			self.blocks.append(Block("Header"))
+			self.blocks.append(self.newBlock("Header"))
 
-		cmds = self.cnc.parseLine(line)
-		if cmds is None:
+		words = self.cnc.parseWords(line)
+		if words is None:
 			self.blocks[-1].append(line)
 			return
 
-		self.cnc.processPath(cmds)
+		self.cnc.processWords(words)
 
 		# rapid move up = end of block
 		if self.cnc.gcode == 0 and self.cnc.dz > 0.0:
-			self.blocks[-1].append(line)
-			self.blocks.append(Block())
+			self.blocks[-1].appendWords(line, words)
+			self.blocks.append(self.newBlock())
 		elif self.cnc.gcode == 0 and len(self.blocks)==1:
-			self.blocks.append(Block())
-			self.blocks[-1].append(line)
+			self.blocks.append(self.newBlock())
+			self.blocks[-1].appendWords(line, words)
 		else:
 			#if line and line[0]=="(":
 			#	self._lastComment = len(self.blocks[1])
-			self.blocks[-1].append(line)
+			self.blocks[-1].appendWords(line, words)
 
 		self.cnc.motionPathEnd()
 
@@ -1024,6 +2642,18 @@ class GCode:
 		self.blocks[bid][lid] = line
 		return undoinfo
 
+	#----------------------------------------------------------------------
+	# Change many lines, given as sequences of block ids, line ids and the
+	# new lines, recording them all in one compact undo
+	#----------------------------------------------------------------------
+	def setLinesListUndo(self, bids, lids, lines):
+		old = []
+		for bid,lid,line in zip(bids, lids, lines):
+			block = self.blocks[bid]
+			old.append(block[lid])
+			block[lid] = line
+		return (self.setLinesListUndo, bids, lids, old)
+
 	#----------------------------------------------------------------------
 	# Insert a new line into block
 	#----------------------------------------------------------------------
@@ -1097,7 +2727,7 @@ class GCode:
 	#----------------------------------------------------------------------
 	def setBlockLinesUndo(self, bid, lines):
 		block = self.blocks[bid]
-		undoinfo = (self.setBlockLinesUndo, block[:])
+		undoinfo = (self.setBlockLinesUndo, bid, block[:])
 		del block[:]
 		block.extend(lines)
 		return undoinfo
@@ -1168,7 +2798,7 @@ class GCode:
 
 	#----------------------------------------------------------------------
 	def setAllBlocksUndo(self, blocks=[]):
-		undoinfo = [self.setAllBlocksUndo, self.blocks]
+		undoinfo = (self.setAllBlocksUndo, self.blocks)
 		self.blocks = blocks
 		return undoinfo
 
@@ -1223,16 +2853,573 @@ class GCode:
 			for line in block:
 				yield line
 
+	#----------------------------------------------------------------------
+	# Iterate over all lines together with their parsed words
+	#----------------------------------------------------------------------
+	def linesWords(self):
+		for block in self.blocks:
+			for i,line in enumerate(block):
+				yield line, block.words(i)
+
 	#----------------------------------------------------------------------
 	# initialize cnc path based on block bid
 	#----------------------------------------------------------------------
 	def initPath(self, bid):
-		if bid == 0:
-			self.cnc.initPath()
+		self.cnc.initPath()
+		# Run through the previous blocks, their exit states are cached
+		for block in self.blocks[:bid]:
+			block.exitState(self.cnc)
+
+	#----------------------------------------------------------------------
+	# @return PathStats of the whole program combining the cached
+	# statistics of the blocks, only modified blocks are recalculated
+	#----------------------------------------------------------------------
+	def stats(self):
+		self.cnc.initPath()
+		stats = PathStats()
+		for block in self.blocks:
+			stats.add(block.stats(self.cnc))
+		return stats
+
+	#----------------------------------------------------------------------
+	# Estimate the job time simulating the acceleration of the machine with
+	# plannerTimes(). The machine stops at M commands and dwells (G4 P in
+	# ms). Arcs are planned as the segments of motionPath()
+	# @return total time and numpy array with the time of each of lines()
+	# in minutes, like CNC.totalTime
+	#----------------------------------------------------------------------
+	def planTime(self, lookahead=PLANNER_BUFFER):
+		cnc = self.cnc
+		cnc.initPath()
+		start = []
+		end   = []
+		feed  = []
+		move  = []	# line of each move
+		stops = []
+		dwell = []	# line, time
+		lid   = 0
+		for block in self.blocks:
+			for i in range(len(block)):
+				words = block.words(i)
+				if words is not None:
+					cnc.processWords(words)
+					if cnc.gcode is None or cnc.gcode==4:
+						stops.append(len(move))
+						if cnc.gcode==4:
+							dwell.append((lid, cnc.pval/1000.0))
+					xyz = cnc.motionPath()
+					f = cnc.gcode != 0 and cnc.feed or 0.0
+					for j in range(1,len(xyz)):
+						if xyz[j] == xyz[j-1]: continue
+						start.append(xyz[j-1])
+						end.append(xyz[j])
+						feed.append(f)
+						move.append(lid)
+					cnc.motionPathEnd()
+				lid += 1
+
+		times = plannerTimes(start, end, feed,
+			(cnc.feedmax_x, cnc.feedmax_y, cnc.feedmax_z),
+			(cnc.acceleration_x, cnc.acceleration_y, cnc.acceleration_z),
+			[s for s in stops if s < len(move)], lookahead)
+		lines = np.bincount(np.array(move, dtype=int), times, lid) \
+			if move else np.zeros(lid)
+		for l,t in dwell: lines[l] += t
+		lines /= 60.0
+		return lines.sum(), lines
+
+	#----------------------------------------------------------------------
+	# Change the feed of the cutting moves by their shape. Straight XY moves
+	# of at least length, turning at most angle degrees at both ends, are
+	# sped up by boost, up to the feedmax of their direction. Arcs of
+	# radius below radius are slowed down in proportion, at most to half.
+	# All other moves keep their feed.
+	# The F words are rewritten as a single undo
+	# @return number of lines changed
+	#----------------------------------------------------------------------
+	def optimizeFeed(self, boost=FEED_BOOST, length=FEED_LENGTH,
+				angle=FEED_ANGLE, radius=FEED_RADIUS):
+		cnc = self.cnc
+		cnc.initPath()
+		cosa  = math.cos(math.radians(angle))
+		items = []	# [bid, lid, F, feed, new feed, entry dir, exit dir, unit]
+		prev  = None	# previous XY feed move, if continuing from it
+		for bid,block in enumerate(self.blocks):
+			for lid in range(len(block)):
+				words = block.words(lid)
+				if words is None: continue
+				cnc.processWords(words)
+				fword = None
+				for c,value,cmd in words:
+					if c == "F": fword = value*cnc.unit
+				moved = cnc.dx != 0.0 or cnc.dy != 0.0
+
+				if cnc.gcode in (1,2,3) and (moved or cnc.dz != 0.0 or
+							      cnc.gcode != 1):
+					item = [bid, lid, fword, cnc.feed, cnc.feed, None, None,
+						cnc.unit]
+					if cnc.gcode == 1 and moved and cnc.dz == 0.0:
+						d  = math.hypot(cnc.dx, cnc.dy)
+						ux = cnc.dx/d
+						uy = cnc.dy/d
+						item[5] = item[6] = (ux, uy)
+						if d >= length:
+							vmax = min(ux and cnc.feedmax_x/abs(ux) or 1e10,
+								   uy and cnc.feedmax_y/abs(uy) or 1e10)
+							item[4] = max(min(cnc.feed*boost, vmax), cnc.feed)
+					elif cnc.gcode in (2,3):
+						xc,yc,zc = cnc.motionCenter()
+						r = cnc.rval
+						if r > 0.0:
+							s = (cnc.gcode==2 and 1.0 or -1.0)/r
+							item[5] = ((cnc.y-yc)*s, (xc-cnc.x)*s)
+							item[6] = ((cnc.yval-yc)*s, (xc-cnc.xval)*s)
+						if r < radius:
+							item[4] = cnc.feed*max(r/radius, 0.5)
+
+					# sharp junctions keep the feed of straight moves
+					if prev is not None and item[5] is not None and \
+					   prev[6][0]*item[5][0] + prev[6][1]*item[5][1] < cosa:
+						if prev[4] > prev[3]: prev[4] = prev[3]
+						if item[4] > item[3]: item[4] = item[3]
+					items.append(item)
+					if item[6] is not None:
+						prev = item
+					else:
+						prev = None
+
+				else:
+					if fword is not None:
+						items.append([bid, lid, fword, None, None, None, None,
+							cnc.unit])
+					prev = None
+				cnc.motionPathEnd()
+
+		# rewrite the F words where the modal feed differs. The new feed is
+		# rounded in the active unit (whole mm/min or 0.1 inch/min) towards
+		# the old one, so the rounding never reverses the change
+		undoinfo = []
+		current  = None	# feed in effect, None when not changed
+		for bid, lid, fword, feed, new, din, dout, unit in items:
+			if new is None:
+				current = fword	# non cutting line
+				continue
+			step = unit==1.0 and 1.0 or 0.1
+			if new > feed:
+				value = math.floor(new/unit/step + 1e-6)*step
+			elif new < feed:
+				value = math.ceil(new/unit/step - 1e-6)*step
+			else:
+				value = new/unit
+			new = value*unit
+			tol = step*unit/2.0
+			if current is None: current = feed
+			if fword is not None and abs(fword-new) < tol or \
+			   fword is None and abs(current-new) < tol:
+				current = new
+				continue
+			f = self.fmt("F", value, 0)
+			words   = self.blocks[bid].words(lid)
+			newcmd  = []
+			for c,value,cmd in words:
+				if c == "F": cmd = cmd[0]+f[1:]
+				newcmd.append(cmd)
+			if fword is None: newcmd.append(f)
+			undoinfo.append(self.setLineUndo(bid, lid, " ".join(newcmd)))
+			current = new
+
+		if undoinfo: self.addUndo(undoinfo)
+		return len(undoinfo)
+
+	#----------------------------------------------------------------------
+	# Check if block can be moved to another place in the program. It has
+	# to start with a rapid XY move, feed moves with their own F and end
+	# raised above the work, without M or other G commands.
+	# cnc must be at the entry state of block, and is left at its exit.
+	# @return entry x,y, exit x,y and the lines of the reversed block
+	# (None if it cannot be reversed) or None if it cannot be moved
+	#----------------------------------------------------------------------
+	def _blockEnds(self, block, reverse=False):
+		cnc    = self.cnc
+		state  = cnc.getState()
+		entry  = None	# target of the first rapid move
+		travel = None	# line of first rapid move
+		feed   = False	# F seen
+		cut    = []	# (line, gcode, x0,y0, x1,y1, xc,yc) moves at cutting level
+		feeds  = set()
+		up     = False	# last motion raised the tool
+		rev    = reverse and cnc.unit==1.0 and cnc.absolute
+		ok     = True
+		for i in range(len(block)):
+			words = block.words(i)
+			if words is None:
+				if cut and not up: rev = False
+				continue
+			letters = [w[0] for w in words]
+			for c,value,cmd in words:
+				if c == "M" or c == "G" and value not in (0.,1.,2.,3.):
+					ok = False
+				elif c == "F":
+					feed = True
+			if not ok: break
+
+			cnc.processWords(words)
+			# a full circle ends where it starts but still cuts
+			moved = cnc.dx != 0.0 or cnc.dy != 0.0 or \
+				cnc.gcode in (2,3) and ("I" in letters or "J" in letters)
+			if cnc.gcode not in (0,1,2,3) or not (moved or cnc.dz != 0.0):
+				pass
+			elif entry is None:
+				# first motion, rapid XY move to the start
+				if cnc.gcode != 0 or cnc.dz != 0.0 or "G" not in letters:
+					ok = False
+					break
+				entry  = (cnc.xval, cnc.yval)
+				travel = i
+				if [c for c in letters if c not in "GXY"]: rev = False
+			elif moved:
+				if cnc.gcode != 0 and not feed:
+					ok = False
+					break
+				if cnc.gcode == 0 or cnc.dz != 0.0 or up: rev = False
+				xc,yc,zc = cnc.motionCenter()
+				cut.append((i, cnc.gcode, cnc.x, cnc.y,
+					    cnc.xval, cnc.yval, xc, yc))
+				feeds.add(cnc.feed)
+				up = False
+			else:
+				if cut and cnc.dz < 0.0: rev = False	# more passes
+				up = cnc.dz > 0.0
+			cnc.motionPathEnd()
+
+		if not ok:
+			cnc.setState(state)
+			block.exitState(cnc)
+			return None
+		if entry is None or not cut or not up or cnc.z <= 0.0:
+			return None
+		exit = (cnc.x, cnc.y)
+
+		# cutting moves must be consecutive
+		first = cut[0][0]
+		last  = cut[-1][0]
+		if not rev or len(feeds)!=1 or last-first+1 != len(cut):
+			return entry, exit, None
+
+		lines = list(block[:travel])
+		lines.append("G0 %s %s"%(self.fmt("X",exit[0]), self.fmt("Y",exit[1])))
+		lines.extend(block[travel+1:first])
+		f = " %s"%(self.fmt("F",feeds.pop()))
+		for i,g,x0,y0,x1,y1,xc,yc in reversed(cut):
+			if g == 1:
+				lines.append("G1 %s %s%s"%(self.fmt("X",x0), self.fmt("Y",y0), f))
+			else:
+				lines.append("G%d %s %s %s %s%s"%(5-g,
+					self.fmt("X",x0), self.fmt("Y",y0),
+					self.fmt("I",xc-x1), self.fmt("J",yc-y1), f))
+			f = ""
+		lines.extend(block[last+1:])
+		return entry, exit, lines
+
+	#----------------------------------------------------------------------
+	# Find the hops of block. The entry is the Z only rapid moves before a
+	# rapid XY travel, and the exit is a Z only rapid retract as the last
+	# motion after an XY move. Blocks with M or other G commands there
+	# have no such hop.
+	# cnc must be at the entry state of block, and is left at its exit.
+	# @return (lift lines, travel x,y,z) or None,
+	#	  (retract line, x,y,z before the retract) or None
+	#----------------------------------------------------------------------
+	def _blockHops(self, block):
+		cnc   = self.cnc
+		enter = None
+		lifts = []	# Z only rapid moves before the travel
+		leave = None
+		entering = True
+		travel = False	# XY move seen
+		for i in range(len(block)):
+			words = block.words(i)
+			if words is None: continue
+			letters = [w[0] for w in words]
+			fixed = False
+			for c,value,cmd in words:
+				if c == "M" or c == "G" and value not in (0.,1.,2.,3.):
+					fixed = True
+
+			cnc.processWords(words)
+			moved = cnc.dx != 0.0 or cnc.dy != 0.0
+			if fixed:
+				entering = False
+				leave = None
+			elif cnc.gcode in (0,1,2,3) and (moved or "Z" in letters):
+				zonly = cnc.gcode == 0 and not moved and \
+					not [c for c in letters if c not in "GNZ"]
+				if entering:
+					if zonly:
+						lifts.append(i)
+					else:
+						if cnc.gcode == 0 and "Z" not in letters:
+							enter = (lifts, cnc.xval, cnc.yval, cnc.zval)
+						entering = False
+				leave = None
+				if zonly and cnc.dz > 0.0:
+					leave = (i, cnc.x, cnc.y, cnc.z)
+				travel = travel or moved
+			cnc.motionPathEnd()
+		if not travel: leave = None
+		return enter, leave
+
+	#----------------------------------------------------------------------
+	# Lower the retract between consecutive visible blocks to the height
+	# needed by each hop: clearance above the work, plus slope per unit of
+	# hop length, so long hops stay high over clamps. With a probe the
+	# highest point of the height map under the hop is the work surface.
+	# The hops are never raised above their original height.
+	# The changes are added as a single undo
+	# @return number of hops lowered and Z travel saved
+	#----------------------------------------------------------------------
+	def adaptRetract(self, clearance=RETRACT_CLEARANCE, slope=RETRACT_SLOPE):
+		self.cnc.initPath()
+		probe = not self.probe.isEmpty()
+		if probe: step = min(self.probe._xstep, self.probe._ystep) / 2.0
+		scale = 10.0**self.cnc.decimal
+		undoinfo = []
+		hops  = 0
+		saved = 0.0
+		last  = None	# bid, retract line, x,y, z before and after
+		for bid,block in enumerate(self.blocks):
+			enter, leave = self._blockHops(block)
+			if not block.visible:
+				last = None
+				continue
+
+			if last is not None and enter is not None and \
+			   abs(enter[3]-last[5]) < 1e-6:
+				pbid, line, x0, y0, zcut, zhop = last
+				lifts, x1, y1, z = enter
+				length = math.hypot(x1-x0, y1-y0)
+				surface = 0.0
+				if probe:
+					n = int(length/step) + 2
+					surface = self.probe.interpolateArray(
+						np.linspace(x0, x1, n),
+						np.linspace(y0, y1, n)).max()
+				h = math.ceil((surface+clearance+slope*length)*scale)/scale
+				if zcut < h < zhop-1e-6:
+					for b,i in [(pbid,line)] + [(bid,i) for i in lifts]:
+						newcmd = []
+						for c,value,cmd in self.blocks[b].words(i):
+							if c == "Z": cmd = self.fmt(cmd[0],h)
+							newcmd.append(cmd)
+						undoinfo.append(self.setLineUndo(b,i," ".join(newcmd)))
+					hops  += 1
+					saved += 2.0*(zhop-h)
+
+			if leave is not None:
+				last = (bid,) + leave + (self.cnc.z,)
+			else:
+				last = None
+
+		if undoinfo: self.addUndo(undoinfo)
+		return hops, saved
+
+	#----------------------------------------------------------------------
+	# Check if block drills a single hole: a rapid XY move to the hole
+	# followed only by Z moves, plunging and ending raised above the work,
+	# without M or other G commands.
+	# cnc must be at the entry state of block, and is left at its exit.
+	# @return x,y of the hole or None
+	#----------------------------------------------------------------------
+	def _drillHit(self, block):
+		cnc    = self.cnc
+		state  = cnc.getState()
+		hit    = None	# target of the rapid move
+		feed   = False	# F seen
+		plunge = False
+		up     = False	# last motion raised the tool
+		ok     = True
+		for i in range(len(block)):
+			words = block.words(i)
+			if words is None: continue
+			letters = [w[0] for w in words]
+			for c,value,cmd in words:
+				if c == "M" or c == "G" and value not in (0.,1.,2.,3.):
+					ok = False
+				elif c == "F":
+					feed = True
+			if not ok: break
+
+			cnc.processWords(words)
+			moved = cnc.dx != 0.0 or cnc.dy != 0.0
+			if cnc.gcode not in (0,1,2,3) or not (moved or cnc.dz != 0.0):
+				pass
+			elif hit is None:
+				if cnc.gcode != 0 or cnc.dz != 0.0 or "G" not in letters:
+					ok = False
+					break
+				hit = (cnc.xval, cnc.yval)
+			elif moved or cnc.gcode != 0 and not feed:
+				ok = False
+				break
+			else:
+				if cnc.dz < 0.0: plunge = True
+				up = cnc.dz > 0.0
+			cnc.motionPathEnd()
+
+		if not ok:
+			cnc.setState(state)
+			block.exitState(cnc)
+			return None
+		if hit is None or not plunge or not up or cnc.z <= 0.0:
+			return None
+		return hit
+
+	#----------------------------------------------------------------------
+	# Reorder the single hole drilling blocks between the fixed ones to
+	# minimize the rapid travel, see orderPoints(). The holes of each run
+	# are grouped by the last tool comment seen, like (T2 0.8mm), and the
+	# groups are kept in the order they first appear.
+	# The new order is added as a single undo
+	# @return travel length before and after
+	#----------------------------------------------------------------------
+	def sequenceDrills(self, timeout=2.0):
+		self.cnc.initPath()
+		runs = []	# [start, blocks, end] of drilling blocks
+		run  = None
+		hits = {}	# bid: x,y
+		tool = {}	# bid: tool comment
+		last = None
+		for bid,block in enumerate(self.blocks):
+			for line in block:
+				if "(" not in line: continue
+				pat = TOOLPAT.search(line)
+				if pat: last = pat.group(1).strip()
+			start = (self.cnc.x, self.cnc.y)
+			hit   = self._drillHit(block)
+			if hit is None:
+				if run is not None:
+					run.append(start)	# end of run
+					runs.append(run)
+				run = None
+				continue
+			hits[bid] = hit
+			tool[bid] = last
+			if run is None: run = [start, []]
+			run[1].append(bid)
+		if run is not None:
+			run.append(None)
+			runs.append(run)
+		if not hits: return 0.0, 0.0
+
+		def travel(p, q):
+			if p is None or q is None: return 0.0
+			return math.hypot(q[0]-p[0], q[1]-p[1])
+
+		before = after = 0.0
+		blocks = list(self.blocks)
+		for start, bids, end in runs:
+			p = start
+			for b in bids:
+				before += travel(p, hits[b])
+				p = hits[b]
+			before += travel(p, end)
+
+			groups = []
+			for b in bids:
+				if tool[b] not in groups: groups.append(tool[b])
+			p = start
+			new = []
+			for g,name in enumerate(groups):
+				group = [b for b in bids if tool[b]==name]
+				if g+1 < len(groups):
+					stop = None
+				else:
+					stop = end
+				for k in orderPoints([hits[b] for b in group], p, stop,
+						timeout*len(group)/len(hits)):
+					b = group[k]
+					after += travel(p, hits[b])
+					p = hits[b]
+					new.append(self.blocks[b])
+			after += travel(p, end)
+			blocks[bids[0]:bids[-1]+1] = new
+
+		if after < before:
+			self.addUndo(self.setAllBlocksUndo(blocks))
 		else:
-			block = self.blocks[bid-1]
-			# Use exiting coords from previous block
-			self.cnc.initPath(block.x, block.y, block.z)
+			after = before
+		return before, after
+
+	#----------------------------------------------------------------------
+	# Reorder (and with reverse also reverse) the movable blocks between
+	# the fixed ones to minimize the rapid travel, see orderPaths()
+	# The new order is added as a single undo
+	# @return travel length before and after
+	#----------------------------------------------------------------------
+	def optimizeOrder(self, reverse=False, timeout=2.0):
+		self.cnc.initPath()
+		runs = []	# [start, blocks ...] of movable blocks
+		run  = None
+		ends = {}	# bid: entry, exit, reversed lines
+		for bid,block in enumerate(self.blocks):
+			start = (self.cnc.x, self.cnc.y)
+			info  = self._blockEnds(block, reverse)
+			if info is None:
+				if run is not None:
+					run.append(start)	# end of run
+					runs.append(run)
+				run = None
+				continue
+			ends[bid] = info
+			if run is None: run = [start, []]
+			run[1].append(bid)
+		if run is not None:
+			run.append(None)
+			runs.append(run)
+
+		def travel(p, q):
+			if p is None or q is None: return 0.0
+			return math.hypot(q[0]-p[0], q[1]-p[1])
+
+		before = after = 0.0
+		blocks = list(self.blocks)
+		for start, bids, end in runs:
+			entries = [ends[b][0] for b in bids]
+			exits   = [ends[b][1] for b in bids]
+			order   = orderPaths(start, entries, exits,
+					[ends[b][2] is not None for b in bids],
+					end, timeout/len(runs))
+
+			p = start
+			for b in bids:
+				before += travel(p, ends[b][0])
+				p = ends[b][1]
+			before += travel(p, end)
+
+			p = start
+			new = []
+			for k,r in order:
+				b = bids[k]
+				entry, exit, lines = ends[b]
+				if r:
+					entry, exit = exit, entry
+					block = self.newBlock(self.blocks[b].name())
+					block.visible = self.blocks[b].visible
+					block.expand  = self.blocks[b].expand
+					block.extend(lines)
+				else:
+					block = self.blocks[b]
+				after += travel(p, entry)
+				p = exit
+				new.append(block)
+			after += travel(p, end)
+			blocks[bids[0]:bids[-1]+1] = new
+
+		if after < before:
+			self.addUndo(self.setAllBlocksUndo(blocks))
+		else:
+			after = before
+		return before, after
 
 	#----------------------------------------------------------------------
 	# Move blocks/lines up
@@ -1275,86 +3462,141 @@ class GCode:
 		return sel
 
 	#----------------------------------------------------------------------
-	# Create a cut my replicating the initial top-only path multiple times
-	# until the maximum height
+	# Compile the lines [start:end] of block into a pass template. Lines
+	# with Z or F words become a format string with %(z)s and %(f)s in
+	# their place together with their words, the other lines are kept
+	# @return list of (line, words, changed)
 	#----------------------------------------------------------------------
-	def cut(self, lines, height, depth_pass, feed):
+	def _passTemplate(self, block, start, end):
+		template = []
+		for i in range(start, end):
+			line  = block[i]
+			words = block.words(i)
+			if words is None:
+				template.append((line, words, False))
+				continue
+			changed = False
+			cmds = []
+			for c,value,cmd in words:
+				if c=="Z":
+					changed = True
+					cmds.append(cmd[0]+"%(z)s")
+				elif c=="F":
+					changed = True
+					cmds.append(cmd[0]+"%(f)s")
+				else:
+					cmds.append(cmd.replace("%","%%"))
+			if changed:
+				template.append((" ".join(cmds), words, True))
+			else:
+				template.append((line, words, False))
+		return template
+
+	#----------------------------------------------------------------------
+	# Append to block one pass of the template at depth z substituting
+	# the Z and F words, together with their parsed words
+	#----------------------------------------------------------------------
+	def _passEmit(self, block, template, z, feed):
+		zs = self.fmt("",z)
+		fs = self.fmt("",feed)
+		values = {"z":zs, "f":fs}
+		zw = float(zs)
+		fw = float(fs)
+		for line, words, changed in template:
+			if changed:
+				words = [(c, zw if c=="Z" else fw, cmd[0]+(zs if c=="Z" else fs))
+						if c in "ZF" else (c,value,cmd)
+						for c,value,cmd in words]
+				line = line % values
+			block.appendWords(line, words)
+
+	#----------------------------------------------------------------------
+	# Create a cut my replicating the initial top-only path multiple times
+	# until the maximum height. The path is compiled once in a template by
+	# _passTemplate() and every pass only substitutes the Z and F values.
+	# With ramp>0 every pass after the plunge to the previous depth enters
+	# the new one zig-zagging along the first linear move of the path for
+	# up to ramp length, instead of plunging vertically.
+	# All the blocks are changed with a single undo
+	#----------------------------------------------------------------------
+	def cut(self, lines, height, depth_pass, feed, ramp=0.0):
+		undoinfo = []
 		for bid,lid in lines:
 			# Operate only on blocks
 			if lid is not None: continue
 			block = self.blocks[bid]
 
-			# 1st detect limits of first pass
+			# 1st detect limits of first pass and its first move
 			start = None
 			end   = None
 			exit  = None
+			entry = None	# x,y at the plunge
+			first = None	# x,y at the end of the first move after it
 			self.initPath(bid)
 			self.cnc.z = self.cnc.zval = 1000.0
-			for i,line in enumerate(block):
-				cmds = self.cnc.parseLine(line)
-				if cmds is None: continue
-				self.cnc.processPath(cmds)
-				#print i,":",self.cnc.dz,self.cnc.z,line
+			for i in range(len(block)):
+				words = block.words(i)
+				if words is None: continue
+				self.cnc.processWords(words)
 				if self.cnc.dz<0.0:
 					if start is None:
 						start = i
-						#print "START"
+						entry = (self.cnc.xval, self.cnc.yval)
 					elif end is None:
 						end = i
-						#print "END"
 				elif self.cnc.dz>0.0 and exit is None:
 					if end is None: end = i
 					exit = i
-					#print "EXIT"
 					break
+				elif start is not None and first is None and \
+				     (self.cnc.dx!=0.0 or self.cnc.dy!=0.0):
+					if self.cnc.gcode==1:
+						first = (self.cnc.xval, self.cnc.yval)
+					else:
+						first = False
 				self.cnc.motionPathEnd()
 			if start is None: start = 0
 			if end   is None: end   = len(block)
 			if exit  is None: exit  = len(block)
 
-			#print "len=",len(block)
-			#print "start=",start
-			#print "end=",end
-			#print "exit=",exit
-			#print
-			#print "start: 0 ..",start
-			#print "\n".join(block[:start])
-			#print
-			#print "path:\n",start,"..",end
-			#print "\n".join(block[start:end])
-			#print
-			#print "exit:\n",exit,"..",len(block)
-			#print "\n".join(block[exit:])
-
-			# 2nd copy starting lines
-			lines = block[:start]
+			zig = None	# X,Y words of the ramp end and its return
+			if ramp>0.0 and entry is not None and first:
+				dx = first[0]-entry[0]
+				dy = first[1]-entry[1]
+				r  = min(ramp, math.sqrt(dx**2 + dy**2))/math.sqrt(dx**2 + dy**2)
+				zig = ("%s %s"%(self.fmt("X",entry[0]+r*dx), self.fmt("Y",entry[1]+r*dy)),
+				       "%s %s"%(self.fmt("X",entry[0]),      self.fmt("Y",entry[1])))
+
+			# 2nd keep starting and remaining lines with their words
+			template = self._passTemplate(block, start, end)
+			head = [(block[i], block.words(i)) for i in range(start)]
+			tail = [(block[i], block.words(i)) for i in range(exit, len(block))]
+			undoinfo.append((self.setBlockLinesUndo, bid, block[:]))
+			del block[:]
+			for line,words in head:
+				block.appendWords(line, words)
 
 			# 3rd duplicate passes from [start:end]
-			z   = 0.0
-			while z > -height:
-				z = max(z-depth_pass, -height)
-
-				for i in range(start, end):
-					line = block[i]
-					cmds = self.cnc.parseLine(line)
-					if cmds is not None:
-						changed = False
-						for j,cmd in enumerate(cmds):
-							c = cmd[0].upper()
-							if c=="Z":
-								changed = True
-								cmds[j] = self.fmt(cmd[0],z)
-							elif c=="F":
-								changed = True
-								cmds[j] = self.fmt(cmd[0],feed)
-						if changed:
-							line = " ".join(cmds)
-					lines.append(line)
+			rest = template
+			if zig:
+				plunge = template[:1]
+				rest   = template[1:]
+			z = 0.0
+			for n in range(1, int(math.ceil(height/depth_pass - 1e-6))+1):
+				prev = z
+				z = max(-n*depth_pass, -height)
+				if zig:
+					# plunge to the previous depth and ramp down
+					self._passEmit(block, plunge, prev, feed)
+					block.append("G1 %s %s %s"%(zig[0],
+							self.fmt("Z",(prev+z)/2.0), self.fmt("F",feed)))
+					block.append("G1 %s %s"%(zig[1], self.fmt("Z",z)))
+				self._passEmit(block, rest, z, feed)
 
 			# 4th copy remaining lines
-			lines.extend(block[exit:])
-
-			self.addUndo(self.setBlockLinesUndo(bid,lines))
+			for line,words in tail:
+				block.appendWords(line, words)
+		if undoinfo: self.addUndo(undoinfo)
 
 	#----------------------------------------------------------------------
 	# make a profile on block
@@ -1383,10 +3625,10 @@ class GCode:
 
 		# Find starting location
 		self.initPath(bid)
-		for i,line in enumerate(block):
-			cmds = self.cnc.parseLine(line)
-			if cmds is None: continue
-			self.cnc.processPath(cmds)
+		for i in range(len(block)):
+			words = block.words(i)
+			if words is None: continue
+			self.cnc.processWords(words)
 			self.cnc.motionPathEnd()
 
 		# FIXME doesn't work
@@ -1425,6 +3667,118 @@ class GCode:
 			bid += 1
 		self.addUndo(undoinfo)
 
+	#----------------------------------------------------------------------
+	# Simplify the runs of G1 moves at the same height and feed of the
+	# selected blocks, like the many tiny segments exported for curves.
+	# Circular runs are replaced by G2/G3 arcs, see fitArcs(), and the
+	# rest by the lines kept by douglasPeucker(), all within tolerance
+	# (default the cnc accuracy). The N words of the replaced lines are
+	# dropped, the lines left unchanged keep them
+	# @return number of lines before and after
+	#----------------------------------------------------------------------
+	def simplify(self, lines, tolerance=None):
+		if tolerance is None: tolerance = self.cnc.accuracy
+		cnc = self.cnc
+		undoinfo = []
+		before = after = 0
+		selected = set([bid for bid,lid in lines if lid is None])
+		cnc.initPath()
+		for bid,block in enumerate(self.blocks):
+			# Operate only on blocks
+			if bid not in selected:
+				block.exitState(cnc)
+				continue
+			new     = []
+			run     = []	# lines of the current run
+			points  = []
+			feed    = None	# F of the first line of the run
+			pending = False	# modal motion left as G2/G3 by an arc
+
+			# @return if the modal motion is left as G2/G3
+			def flush():
+				if not run: return pending
+				if len(run) < 2:
+					line = block[run[0]]
+					if pending and not [w for w in block.words(run[0])
+							if w[0]=="G" and w[1] in (0.,1.,2.,3.)]:
+						line = "G1 " + line
+					new.append(line)
+					return False
+				xy = np.array(points)[:,:2]
+				f  = feed and " %s"%(feed) or ""
+				arc = False
+				for first, last, arc in fitArcs(xy, tolerance):
+					if arc is None:
+						keep = douglasPeucker(xy[first:last+1], tolerance)
+						for k in keep[1:]:
+							x,y = xy[first+k]
+							new.append("G1 %s %s%s"%(self.fmt("X",x/cnc.unit),
+								self.fmt("Y",y/cnc.unit), f))
+							f = ""
+					else:
+						x0,y0 = xy[first]
+						x,y   = xy[last]
+						xc,yc,ccw = arc
+						new.append("G%d %s %s %s %s%s"%(ccw and 3 or 2,
+							self.fmt("X",x/cnc.unit), self.fmt("Y",y/cnc.unit),
+							self.fmt("I",(xc-x0)/cnc.unit),
+							self.fmt("J",(yc-y0)/cnc.unit), f))
+						f = ""
+				return arc is not None
+
+			for i in range(len(block)):
+				words = block.words(i)
+				if words is None:
+					pending = flush()
+					del run[:]
+					new.append(block[i])
+					continue
+				letters = [w[0] for w in words]
+				cnc.processWords(words)
+				if cnc.gcode == 1 and cnc.absolute and cnc.dz == 0.0 and \
+				   (cnc.dx != 0.0 or cnc.dy != 0.0) and \
+				   not [c for c in letters if c not in "GNXYZF"] and \
+				   (not run or cnc.feed == points[0][2]):
+					if not run:
+						feed = None
+						for c,value,cmd in words:
+							if c == "F": feed = cmd
+						del points[:]
+						points.append((cnc.x, cnc.y, cnc.feed))
+					run.append(i)
+					points.append((cnc.xval, cnc.yval, cnc.feed))
+				else:
+					pending = flush()
+					del run[:]
+					line = block[i]
+					if [w for w in words if w[0]=="G" and w[1] in (0.,1.,2.,3.)]:
+						pending = False
+					elif pending and [c for c in letters if c in "XYZ"]:
+						line = "G1 " + line
+						pending = False
+					new.append(line)
+				cnc.motionPathEnd()
+			pending = flush()
+			if pending and bid+1 < len(self.blocks):
+				# next motion must not continue as an arc, skip the
+				# lines before it like M codes and comments
+				nxt = self.blocks[bid+1]
+				for i in range(len(nxt)):
+					words = nxt.words(i)
+					if words is None: continue
+					if [w for w in words if w[0]=="G" and w[1] in (0.,1.,2.,3.)]:
+						break
+					if [w for w in words if w[0] in "XYZ"]:
+						undoinfo.append(self.setLineUndo(bid+1, i,
+								"G1 "+nxt[i]))
+						break
+			before += len(block)
+			after  += len(new)
+			if new == list(block): continue
+			undoinfo.append(self.setBlockLinesUndo(bid, new))
+		if undoinfo: self.addUndo(undoinfo)
+		return before, after
+
 	#----------------------------------------------------------------------
 	# Modify the lines according to the supplied function and arguments
 	#----------------------------------------------------------------------
@@ -1435,24 +3789,19 @@ class GCode:
 
 		for bid,lid in self.iterate(lines):
 			block = self.blocks[bid]
-			cmds = self.cnc.parseLine(block[lid])
-			if cmds is None: continue
+			words = block.words(lid)
+			if words is None: continue
 
 			# Collect all values
 			new.clear()
-			for cmd in cmds:
-				c = cmd[0].upper()
-				try:
-					new[c] = float(cmd[1:])
-				except:
-					new[c] = 0.0
+			for c,value,cmd in words:
+				new[c] = value
 
 			# Modify values with func
 			if func(new, old, *args):
 				# Reconstruct new cmd
 				newcmd = []
-				for cmd in cmds:
-					c = cmd[0].upper()
+				for c,value,cmd in words:
 					old[c] = new[c]
 					newcmd.append(self.fmt(cmd[0],new[c]))
 				undoinfo.append(self.setLineUndo(bid,lid," ".join(newcmd)))
@@ -1460,6 +3809,240 @@ class GCode:
 		# XXX should I add it here or return it to be added later?
 		self.addUndo(undoinfo)
 
+	#----------------------------------------------------------------------
+	# Collect the coordinates of lines for _transformWords(). Like process()
+	# the missing X or Y of a line is the last one of the lines before,
+	# starting from x,y. Lines with axes words that are not numbers, like
+	# expressions X[#1], are left out and passed through unchanged
+	# @return block ids, line ids, words, modal motion and arrays with the
+	# x,y and i,j of the lines having any of the axes words
+	#----------------------------------------------------------------------
+	def _coordinates(self, lines, axes="XYIJ", x=0.0, y=0.0):
+		bids  = array("i")
+		lids  = array("i")
+		found = []
+		modal = []
+		xy    = array("d")
+		ij    = array("d")
+		g = None
+		for bid,lid in self.iterate(lines):
+			words = self.blocks[bid].words(lid)
+			if words is None: continue
+			i = j = 0.0
+			coords = True
+			for c,value,cmd in words:
+				if c in axes and value == 0.0:
+					try:
+						float(cmd[1:])
+					except ValueError:
+						coords = False
+						break
+			if not coords:
+				# passed through, keeping the position but not the motion
+				for c,value,cmd in words:
+					if c == "G" and value in (0.,1.,2.,3.):
+						g = int(value)
+				continue
+			coords = False
+			for c,value,cmd in words:
+				if c in axes:
+					coords = True
+					if c == "X":
+						x = value
+					elif c == "Y":
+						y = value
+					elif c == "I":
+						i = value
+					elif c == "J":
+						j = value
+				elif c == "G" and value in (0.,1.,2.,3.):
+					g = int(value)
+			if coords:
+				bids.append(bid)
+				lids.append(lid)
+				found.append(words)
+				modal.append(g)
+				xy.extend((x,y))
+				ij.extend((i,j))
+		return bids, lids, found, modal, \
+			np.frombuffer(xy).reshape(-1,2), np.frombuffer(ij).reshape(-1,2)
+
+	#----------------------------------------------------------------------
+	# Apply the 3x3 affine matrix m to the coordinates of _coordinates()
+	# at once and move Z by dz. The missing X or Y of a line is written
+	# when m mixes the axes. Mirroring swaps G2 and G3, adding the G to
+	# the lines continuing a modal arc. The words of the new lines, as
+	# CNC.parseWords(), are appended to the parsed list if given
+	# @return list of the new lines
+	#----------------------------------------------------------------------
+	def _transformWords(self, found, modal, xy, ij, m, dz=0.0, parsed=None):
+		mix  = m[0,1] != 0.0 or m[1,0] != 0.0
+		flip = m[0,0]*m[1,1] - m[0,1]*m[1,0] < 0.0
+		xs, ys  = (xy.dot(m[:2,:2].T) + m[:2,2]).T.tolist()
+		is_, js = ij.dot(m[:2,:2].T).T.tolist()
+
+		fmt = self.fmt
+		new = []
+		for k in range(len(found)):
+			words = found[k]
+			g = modal[k]
+			if mix or flip:
+				letters = [w[0] for w in words]
+			newcmd = []
+			if flip and g in (2,3) and "G" not in letters:
+				newcmd.append("G%d"%(5-g))
+			for c,value,cmd in words:
+				if c == "X":
+					newcmd.append(fmt(cmd[0], xs[k]))
+					if mix and "Y" not in letters: newcmd.append(fmt("Y", ys[k]))
+				elif c == "Y":
+					if mix and "X" not in letters: newcmd.append(fmt("X", xs[k]))
+					newcmd.append(fmt(cmd[0], ys[k]))
+				elif c == "I":
+					newcmd.append(fmt(cmd[0], is_[k]))
+					if mix and "J" not in letters: newcmd.append(fmt("J", js[k]))
+				elif c == "J":
+					if mix and "I" not in letters: newcmd.append(fmt("I", is_[k]))
+					newcmd.append(fmt(cmd[0], js[k]))
+				elif c == "Z" and dz != 0.0:
+					newcmd.append(fmt(cmd[0], value+dz))
+				elif c == "G" and flip and value in (2.,3.):
+					newcmd.append("%s%d"%(cmd[0], 5-int(value)))
+				else:
+					newcmd.append(cmd)
+			new.append(" ".join(newcmd))
+			if parsed is not None:
+				parsed.append(CNC.parseWords(new[-1]))
+		return new
+
+	#----------------------------------------------------------------------
+	# Transform the XY coordinates of lines with an affine matrix, either
+	# 3x3 acting on (x,y,1) or a 4x4 bmath.Matrix also giving the Z offset,
+	# and move Z by dz. The coordinates of all lines are collected in
+	# arrays and transformed at once, see _transformWords().
+	# The changes are added as a single undo
+	#----------------------------------------------------------------------
+	def transformLines(self, lines, matrix, dz=0.0):
+		m = np.asarray(matrix, dtype=float)
+		if m.shape == (4,4):
+			dz += m[2,3]
+			m = m[np.ix_((0,1,3),(0,1,3))]
+		bids, lids, found, modal, xy, ij = \
+			self._coordinates(lines, dz != 0.0 and "XYIJZ" or "XYIJ")
+		if not found: return
+		new = self._transformWords(found, modal, xy, ij, m, dz)
+		self.addUndo(self.setLinesListUndo(bids, lids, new))
+
+	#----------------------------------------------------------------------
+	# Step and repeat the blocks from the first to the last cutting one,
+	# having feed moves in XY and no M codes, in nx by ny copies, pitch
+	# (a number or dx,dy) apart. The header, the spindle start, the final
+	# park move and the program end are left once outside the copies.
+	# With rotation (degrees) every copy, including the first, is rotated
+	# around the center of the template. The template is parsed once and
+	# the copies are generated with _transformWords(), keeping their
+	# words parsed, and ordered with orderPaths() to minimize the travel
+	# between them.
+	# The probe height map covering the returned margins levels all the
+	# copies, as they are leveled together with the rest of the program.
+	# The new blocks are added as a single undo
+	# @return PathStats of the panel
+	#----------------------------------------------------------------------
+	def panelize(self, nx, ny, pitch, rotation=0.0, timeout=2.0):
+		try:
+			px, py = pitch
+		except TypeError:
+			px = py = pitch
+		template = []	# cutting blocks
+		motions  = []	# modal motion at the start of each block
+		g = None
+		for bid,block in enumerate(self.blocks):
+			motions.append(g)
+			cutting = mcode = False
+			for i in range(len(block)):
+				words = block.words(i)
+				if words is None: continue
+				move = False
+				for c,value,cmd in words:
+					if c=="G" and (value in (0.,1.,2.,3.) or 81.<=value<=89.):
+						g = int(value)
+					elif c=="M":
+						mcode = True
+					elif c=="X" or c=="Y":
+						move = True
+				if move and g: cutting = True
+			if cutting and not mcode: template.append(bid)
+		if not template or nx*ny <= 1: return self.stats()
+		first, last = template[0], template[-1]
+
+		self.initPath(first)
+		start = (self.cnc.x, self.cnc.y)
+		motion = motions[first]
+		bids, lids, found, modal, xy, ij = self._coordinates(
+				[(bid,None) for bid in range(first, last+1)], "XYIJ", *start)
+		if not found: return self.stats()
+		rows = {}	# bid: first index of its lines in found
+		for k in range(len(bids)-1, -1, -1): rows[bids[k]] = k
+
+		# a copy follows the end of another one, repeat the motion
+		# the template was entered with
+		entry = ""
+		if modal[0] is None and motion is not None:
+			entry = "G%d "%(motion)
+
+		x0 = (xy[:,0].min() + xy[:,0].max())/2.0
+		y0 = (xy[:,1].min() + xy[:,1].max())/2.0
+		a  = math.radians(rotation)
+		c, s = math.cos(a), math.sin(a)
+		if rotation%90.0 == 0.0:
+			c = round(c)
+			s = round(s)
+
+		copies = []	# (i, j, matrix)
+		for j in range(ny):
+			for i in range(nx):
+				copies.append((i, j, np.array(
+					[[c, -s, x0 - c*x0 + s*y0 + i*px],
+					 [s,  c, y0 - s*x0 - c*y0 + j*py],
+					 [0.0, 0.0, 1.0]])))
+
+		# order the copies by the entry and exit of the template
+		ends    = np.array([xy[0], xy[-1]]).T
+		entries = [m[:2,:2].dot(ends[:,0]) + m[:2,2] for i,j,m in copies]
+		exits   = [m[:2,:2].dot(ends[:,1]) + m[:2,2] for i,j,m in copies]
+		order   = orderPaths(start, entries, exits, [False]*len(copies),
+				None, timeout)
+
+		blocks = self.blocks[:first]
+		for n,(k,r) in enumerate(order):
+			i, j, m = copies[k]
+			if n==0 and i==0 and j==0 and rotation%360.0 == 0.0:
+				blocks.extend(self.blocks[first:last+1])
+				continue
+			parsed = []
+			new = self._transformWords(found, modal, xy, ij, m, 0.0, parsed)
+			if entry:
+				new[0] = entry + new[0]
+				parsed[0].insert(0, ("G", float(motion), entry[:-1]))
+			for bid in range(first, last+1):
+				orig  = self.blocks[bid]
+				block = self.newBlock("%s [%d,%d]"%(orig.name(), i, j))
+				block.visible = orig.visible
+				block.expand  = False
+				lines = list(orig)
+				words = [orig.words(lid) for lid in range(len(orig))]
+				k = rows.get(bid)
+				while k is not None and k < len(bids) and bids[k] == bid:
+					lines[lids[k]] = new[k]
+					words[lids[k]] = parsed[k]
+					k += 1
+				for line,w in zip(lines, words):
+					block.appendWords(line, w)
+				blocks.append(block)
+		blocks.extend(self.blocks[last+1:])
+		self.addUndo(self.setAllBlocksUndo(blocks))
+		return self.stats()
+
 	#----------------------------------------------------------------------
 	# Move position by dx,dy,dz
 	#----------------------------------------------------------------------
@@ -1485,7 +4068,8 @@ class GCode:
 		elif dx == "DOWN":
 			self.moveDown(lines)
 		else:
-			return self.process(lines, self.moveFunc, dx, dy, dz)
+			return self.transformLines(lines,
+					[[1.0, 0.0, dx], [0.0, 1.0, dy], [0.0, 0.0, 1.0]], dz)
 
 	#----------------------------------------------------------------------
 	# Rotate position by c(osine), s(ine) of an angle around center (x0,y0)
@@ -1515,7 +4099,10 @@ class GCode:
 		if ang in (0.0,90.0,180.0,270.0,-90.0,-180.0,-270.0):
 			c = round(c)	# round numbers to avoid nasty extra digits
 			s = round(s)
-		return self.process(lines, self.rotateFunc, c, s, x0, y0)
+		return self.transformLines(lines,
+				[[c, -s, x0 - c*x0 + s*y0],
+				 [s,  c, y0 - s*x0 - c*y0],
+				 [0.0, 0.0, 1.0]])
 
 	#----------------------------------------------------------------------
 	# Mirror Horizontal
@@ -1553,10 +4140,10 @@ class GCode:
 	# Mirror horizontally/vertically
 	#----------------------------------------------------------------------
 	def mirrorHLines(self, lines):
-		return self.process(lines, self.mirrorHFunc)
+		return self.transformLines(lines, np.diag((-1.0, 1.0, 1.0)))
 
 	def mirrorVLines(self, lines):
-		return self.process(lines, self.mirrorVFunc)
+		return self.transformLines(lines, np.diag((1.0, -1.0, 1.0)))
 
 	#----------------------------------------------------------------------
 	# Round all digits with accuracy
@@ -1590,16 +4177,15 @@ class GCode:
 		#for line in self.iterate():
 		#for bid,block in enumerate(self.blocks):
 		#	for li,line in enumerate(block):
-		for line in self.lines():
+		for line,words in self.linesWords():
 			# step id
 			# 0 - normal cutting z<0
 			# 1 - z>0 raised  with dx=dy=0.0
 			# 2 - z<0 plunged with dx=dy=0.0
-			cmd = self.cnc.parseLine(line)
-			if cmd is None:
+			if words is None:
 				newlines.append(line)
 				continue
-			self.cnc.processPath(cmd)
+			self.cnc.processWords(words)
 			xyz = self.cnc.motionPath()
 			if self.cnc.dx==0.0 and self.cnc.dy==0.0:
 				if self.cnc.z>0.0 and self.cnc.dz>0.0:
@@ -1639,66 +4225,283 @@ class GCode:
 	def removeNlines(self, lines):
 		pass
 
+	#----------------------------------------------------------------------
+	# Reformat the numbers of a parsed line
+	#----------------------------------------------------------------------
+	def formatLine(self, words):
+		newcmd = []
+		for c,value,cmd in words:
+			if c in ("F","X","Y","Z","I","J","K","R","P",):
+				cmd = self.fmt(cmd[0],value)
+			newcmd.append(cmd)
+		return " ".join(newcmd)
+
+	#----------------------------------------------------------------------
+	# Parse one block for autoleveling. Non motion lines are appended to
+	# out as-is, while motions are appended as (first segment, #segments, feed)
+	# with their linear segments collected in segments
+	#----------------------------------------------------------------------
+	def _levelBlock(self, block, out, segments, paths):
+		for i,line in enumerate(block):
+			words = block.words(i)
+			if words is None: continue
+
+			self.cnc.processWords(words)
+			if self.cnc.gcode in (1,2,3):
+				for c,value,cmd in words:
+					if c == 'F':
+						feed = cmd
+						break
+				else:
+					feed = ""
+
+			if self.cnc.gcode in (2,3) and \
+			   (self.probe.arcs and self.probe.tolerance > 0.0 or \
+			    self.probe.activePlane() is not None) and \
+			   self._levelArc(out, segments, feed):
+				self.cnc.motionPathEnd()
+				continue
+
+			xyz = self.cnc.motionPath()
+			self.cnc.motionPathEnd()
+			if not xyz:
+				# while auto-levelling, do not ignore non-movement lines
+				# so just append the line as-is
+				out.append(line)
+				paths.append(None)
+				continue
+
+			if self.cnc.gcode in (1,2,3):
+				out.append((len(segments), len(xyz)-1, feed))
+				for k in range(1,len(xyz)):
+					segments.append(xyz[k-1]+xyz[k])
+				continue
+
+			out.append(self.formatLine(words))
+
+	#----------------------------------------------------------------------
+	# Level the current arc motion of cnc keeping it as helical G2/G3 moves
+	# wherever the Z correction along the arc is linear within the probe
+	# tolerance. The rest is bisected and, once shorter than a couple of
+	# linearization steps, split as lines. Return False for invalid arcs
+	#----------------------------------------------------------------------
+	def _levelArc(self, out, segments, feed):
+		cnc = self.cnc
+		x0, y0, z0 = cnc.x, cnc.y, cnc.z
+		xc,yc,zc = cnc.motionCenter()
+		r = cnc.rval
+		if r <= 0.0: return False
+
+		phi  = math.atan2(y0-yc, x0-xc)
+		ephi = math.atan2(cnc.yval-yc, cnc.xval-xc)
+		if cnc.gcode==2:
+			if ephi>=phi-1e-10: ephi -= 2.0*math.pi
+		else:
+			if ephi<=phi+1e-10: ephi += 2.0*math.pi
+		sweep = ephi - phi
+		dz = cnc.zval - z0
+
+		df = cnc.arcStep(r)
+		# sampling step, fine enough to see every probe cell crossed
+		ds = min(self.probe._xstep, self.probe._ystep) / 4.0 / r
+		ds = min(ds, math.pi/16.0)
+
+		def point(u):
+			f = phi + u*sweep
+			return xc + r*math.cos(f), yc + r*math.sin(f), z0 + u*dz
+
+		def level(ua, ub):
+			n = int(math.ceil(abs(sweep)*(ub-ua)/ds)) + 1
+			u = np.linspace(ua, ub, max(n,3))
+			f = phi + u*sweep
+			c = self.probe.interpolateArray(xc+r*np.cos(f), yc+r*np.sin(f))
+			lin = c[0] + (c[-1]-c[0])*(u-ua)/(ub-ua)
+			if np.abs(c-lin).max() <= self.probe.tolerance:
+				xa,ya,za = point(ua)
+				xb,yb,zb = point(ub)
+				return ["G%d %s %s %s %s %s"% \
+					(cnc.gcode,
+					 self.fmt("X",xb), self.fmt("Y",yb),
+					 self.fmt("Z",zb+c[-1]),
+					 self.fmt("I",xc-xa), self.fmt("J",yc-ya))]
+
+			if abs(sweep)*(ub-ua) > 2.0*df:
+				um = 0.5*(ua+ub)
+				return level(ua, um) + level(um, ub)
+
+			# linearize as motionPath() would do
+			n  = max(int(math.ceil(abs(sweep)*(ub-ua)/df)), 1)
+			pts = [point(ua + (ub-ua)*k/float(n)) for k in range(n+1)]
+			item = (len(segments), n)
+			for k in range(n):
+				segments.append(pts[k]+pts[k+1])
+			return [item]
+
+		for item in level(0.0, 1.0):
+			if isinstance(item, tuple):
+				out.append(item+(feed,))
+			else:
+				out.append(("%s %s"%(item, feed)).rstrip())
+			feed = ""
+		return True
+
+	#----------------------------------------------------------------------
+	# Split all collected segments with a single Probe.splitLines() call
+	# and append the leveled lines. out and segments are emptied
+	#----------------------------------------------------------------------
+	def _levelFlush(self, out, segments, lines):
+		if segments:
+			xyz, index = self.probe.splitLines(segments)
+			xyz = xyz.tolist()
+			index = index.tolist()
+
+		for item in out:
+			if not isinstance(item, tuple):
+				lines.append(item)
+				continue
+			first, count, feed = item
+			for x,y,z in xyz[index[first]:index[first+count]]:
+				lines.append(("G1 %s %s %s %s"%\
+					(self.fmt("X",x),
+					 self.fmt("Y",y),
+					 self.fmt("Z",z),
+					 feed)).rstrip())
+				feed = ""
+		del out[:]
+		del segments[:]
+
 	#----------------------------------------------------------------------
 	# Use probe information to modify the g-code to autolevel
 	#----------------------------------------------------------------------
 	def prepare2Run(self):
+		paths = []
+		lines = list(self.prepare2RunIter(paths))
+		return lines,paths
+
+	#----------------------------------------------------------------------
+	# Generator version of prepare2Run() yielding the lines block by block.
+	# At most LEVEL_CHUNK segments are kept in memory at any time
+	#----------------------------------------------------------------------
+	def prepare2RunIter(self, paths=None):
 		autolevel = not self.probe.isEmpty()
+		keep = paths is not None
+		if not keep: paths = []
 
-		lines = []
-		paths = []
+		lines    = []
+		out      = []
+		segments = []
 		for block in self.blocks:
-			#print "Blocks: "+str(len(self.blocks));
-			#print "Paths in current block: "+str(len(block._path))
 			if not block.visible: continue
-			for i,line in enumerate(block):
-				newcmd = []
-				cmds = self.cnc.parseLine(line)
-				#print cmds
-				if cmds is None: continue
-
-				if autolevel:
-					self.cnc.processPath(cmds)
-					xyz = self.cnc.motionPath()
-					self.cnc.motionPathEnd()
-					#print xyz
-					if not xyz:
-						# while auto-levelling, do not ignore non-movement lines
-						# so just append the line as-is
-						lines.append(line)
-						paths.append(None)
-						#print line
-						continue
-
-					if self.cnc.gcode in (1,2,3):
-						for c in cmds:
-							if c[0] in ('f','F'):
-								feed = c
-								break
-						else:
-							feed = ""
-
-						x1,y1,z1 = xyz[0]
-						for x2,y2,z2 in xyz[1:]:
-							for x,y,z in self.probe.splitLine(x1,y1,z1,x2,y2,z2):
-								lines.append(" G1 %s %s %s %s"%\
-									(self.fmt("X",x),
-									 self.fmt("Y",y),
-									 self.fmt("Z",z),
-									 feed))
-								#paths.append(block._path[i])
-								feed = ""
-							x1,y1,z1 = x2,y2,z2
-						lines[-1] = lines[-1].strip()
-						continue
-
-				for cmd in cmds:
-					c = cmd[0]
-					try: value = float(cmd[1:])
-					except: value = 0.0
-					if c.upper() in ("F","X","Y","Z","I","J","K","R","P",):
-						cmd = self.fmt(c,value)
-					newcmd.append(" "+cmd)
-				lines.append(("".join(newcmd)).strip())
-				#paths.append(block._path[i])
-		return lines,paths
+			if autolevel:
+				self._levelBlock(block, out, segments, paths)
+				if isinstance(block, LazyBlock): block.release()
+				if len(segments) < LEVEL_CHUNK and len(out) < LEVEL_CHUNK:
+					continue
+				self._levelFlush(out, segments, lines)
+			else:
+				for i,line in enumerate(block):
+					words = block.words(i)
+					if words is None: continue
+					lines.append(self.formatLine(words))
+				if isinstance(block, LazyBlock): block.release()
+			for line in lines: yield line
+			del lines[:]
+			if not keep: del paths[:]
+
+		self._levelFlush(out, segments, lines)
+		for line in lines: yield line
+
+	#----------------------------------------------------------------------
+	# Split the visible blocks in tasks of about LEVEL_TASK lines for the
+	# leveling processes. A cheap pass without motion paths tracks the cnc
+	# state on entry of each task. Yield (state, list of block lines)
+	#----------------------------------------------------------------------
+	def _levelTasks(self):
+		state  = self.cnc.getState()
+		blocks = []
+		size   = 0
+		for block in self.blocks:
+			if not block.visible: continue
+			if size >= LEVEL_TASK:
+				yield state, blocks
+				state  = self.cnc.getState()
+				blocks = []
+				size   = 0
+			blocks.append(list(block))
+			size += len(block)
+			block.exitState(self.cnc)
+			if isinstance(block, LazyBlock): block.release()
+		if blocks:
+			yield state, blocks
+
+	#----------------------------------------------------------------------
+	# Parallel version of prepare2RunIter() leveling the blocks on a pool of
+	# processes (default one per cpu). The lines are yielded in order and
+	# at most two tasks per process are pending at any time
+	#----------------------------------------------------------------------
+	def prepare2RunParallel(self, processes=None):
+		if self.probe.isEmpty():
+			for line in self.prepare2RunIter(): yield line
+			return
+
+		if processes is None: processes = multiprocessing.cpu_count()
+		pool = multiprocessing.Pool(processes, _levelInit,
+				(self.probe, self.cnc.accuracy, self.cnc.decimal))
+		try:
+			pending = collections.deque()
+			for task in self._levelTasks():
+				pending.append(pool.apply_async(_levelTask, (task,)))
+				if len(pending) < 2*processes: continue
+				for line in pending.popleft().get(): yield line
+			while pending:
+				for line in pending.popleft().get(): yield line
+			pool.close()
+		finally:
+			pool.terminate()
+			pool.join()
+
+	#----------------------------------------------------------------------
+	# Write the autoleveled g-code directly to a file, using a pool of
+	# processes when processes is not 1 (None = one per cpu)
+	#----------------------------------------------------------------------
+	def save2Run(self, filename, processes=1):
+		try:
+			f = open(filename,"w")
+		except:
+			return False
+		if processes == 1:
+			lines = self.prepare2RunIter()
+		else:
+			lines = self.prepare2RunParallel(processes)
+		for line in lines:
+			f.write("%s\n"%(line))
+		f.close()
+		return True
+
+#------------------------------------------------------------------------------
+# Leveling processes of GCode.prepare2RunParallel(). The probe is sent once
+# when the process starts and each task carries the cnc state on entry
+#------------------------------------------------------------------------------
+_levelGCode = None
+
+def _levelInit(probe, accuracy, decimal):
+	global _levelGCode
+	_levelGCode = GCode()
+	_levelGCode.probe = probe
+	_levelGCode.cnc.accuracy = accuracy
+	_levelGCode.cnc.decimal  = decimal
+
+def _levelTask(task):
+	state, blocks = task
+	gcode = _levelGCode
+	gcode.cnc.setState(state)
+	lines    = []
+	out      = []
+	segments = []
+	paths    = []
+	for blines in blocks:
+		block = Block()
+		block.extend(blines)
+		gcode._levelBlock(block, out, segments, paths)
+	gcode._levelFlush(out, segments, lines)
+	return lines
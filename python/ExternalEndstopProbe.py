@@ -17,6 +17,9 @@ global bedScanYGranularityNr
 
 
 num_probes = 1
+min_probes = 3	# probes per point before the early stop can be considered
+z_confidence = 0.01	# stop probing a point once the 95% confidence half-width of its Z is below this (mm)
+z_resolution = 0.01	# resolution of the reported endstop Z (mm), the smallest spread trusted
 retractProbe = False
 feedrate = 200
 start_time = time.time()
@@ -43,22 +46,27 @@ try:
 		feedrate = 100	
 		retractProbe = False
 		num_probes = 5
+		z_confidence = 0.02
 	if (accuracy == 50): 
 		feedrate = 100
 		retractProbe = True
 		num_probes = 10
+		z_confidence = 0.01
 	if (accuracy == 100):
 		feedrate = 100
 		retractProbe = True
 		num_probes = 100
+		z_confidence = 0.005
 	if (accuracy == 150):
 		feedrate = 20
 		retractProbe = True
 		num_probes = 8
+		z_confidence = 0.005
 	if (accuracy == 200):
 		feedrate = 20
 		retractProbe = True
 		num_probes = 16 
+		z_confidence = 0.002
 	
 	if (calibrationMethod == "BED_MEASUREMENT" or calibrationMethod == "SCREW_CALIBRATION"):
 		pointsFile = open(points_file, "r") 
@@ -160,6 +168,20 @@ def printlog():
 	print>>handle, str_log
 	return	
 
+# Robust statistics of the probes of one point
+# returns the median, the spread (MAD scaled to a standard deviation) and
+# the 95% confidence half-width of the median
+# The quantized readings often give a MAD of 0, then the standard deviation
+# is used, and the spread is never below the quantization error of z_resolution
+def probe_stats(samples):
+	z = np.array(samples, dtype=float)
+	median = np.median(z)
+	spread = 1.4826 * np.median(np.abs(z - median))
+	if spread == 0.0: spread = np.std(z, ddof=1) if len(z)>1 else 0.0
+	spread = max(spread, z_resolution / np.sqrt(12.0))
+	halfwidth = 1.96 * 1.2533 * spread / np.sqrt(len(z))
+	return median, spread, halfwidth
+
 def read_serial(gcode):
 	serial.flushInput()
 	serial.write(gcode + "\r\n")
@@ -261,6 +283,7 @@ for (p,point) in enumerate(probed_points):
 				macro("G0 Z"+str(zp)+" F5000","ok",10,"Rising Bed",0, warning=True, verbose=False)
 
 
+		samples = []
 		for i in range(0,num_probes):
 			# Raise probe first, to level out errors of probe retracts?!?
 #			if (retractProbe == True):
@@ -280,7 +303,7 @@ for (p,point) in enumerate(probed_points):
 				if (time.time() - probe_start_time>240):	#timeout management
 					trace("Probe failed on this point")
 					probes-=1 #failed, update counter
-					point[2][i]("N/A")
+					point[2][i] = "N/A"
 					break	
 				pass
 			
@@ -290,6 +313,7 @@ for (p,point) in enumerate(probed_points):
 				z=serial_reply.split("Z:")[1].strip()
 				#trace("probe no. "+str(i+1)+" = "+str(z) )
 				point[2][i]=z # store Z
+				samples.append(float(z))
 			
 			serial_reply=""
 			serial.flushInput()
@@ -298,11 +322,23 @@ for (p,point) in enumerate(probed_points):
 			trace(msg)
 			printlog()
 		
+			# stop once the median is known well enough
+			if len(samples)>=min_probes and probe_stats(samples)[2] < z_confidence:
+				pointsMeasured += num_probes-i-1 # skipped probes count as done for the progress
+				point[2] = point[2][:i+1]
+				break
+
 			#G0 Z40 F5000
 			if(num_probes>1):
 				macro("G0 Z"+str(zp)+" F5000","ok",10,"Rising Bed",0, warning=True, verbose=False)
 		
-		#mean of the num of measurements
+		# aggregated Z and spread of the measurements
+		if samples:
+			z_point, z_spread, z_halfwidth = probe_stats(samples)
+			point.append(z_point)
+			point.append(z_spread)
+			trace("Point "+str(p)+": Z="+str(z_point)+" spread="+str(z_spread)+" ("+str(len(samples))+" probes)")
+			printlog()
 	
 
 	macro("G0 Z"+str(zp)+" F5000","ok",2,"Rising Bed",0.5, warning=True, verbose=False)
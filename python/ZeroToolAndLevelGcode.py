@@ -35,6 +35,18 @@ try:
 	dozero = str(sys.argv[6]); # 0 = do not Zero, 1 = do Zero
 
 	zoffset_ovr = float(sys.argv[7]);
+
+	leveling_tolerance = 0.0 # max Z error in mm when leveling, 0 = split on every probe grid line
+	if len(sys.argv)>8:
+		leveling_tolerance = float(sys.argv[8]);
+
+	leveling_arcs = False # 1 = keep arcs as G2/G3 where within the leveling tolerance
+	if len(sys.argv)>9:
+		leveling_arcs = str(sys.argv[9]) == "1";
+
+	leveling_planar = False # 1 = correct only the tilt when a plane fits the points within the leveling tolerance
+	if len(sys.argv)>10:
+		leveling_planar = str(sys.argv[10]) == "1";
 	pointsFile = open(points_file, "r") 
 	bedPoints=pointsFile.read()
 	bed_measurement_points = json.loads(bedPoints) #np.array(json.loads(bedPoints))
@@ -202,8 +214,6 @@ macro("M746 S0","ok",2,"Disabling external probe",1, verbose=False)
 trace("Leveling gcode file...\r\n")
 gcode = CNC.GCode();
 
-gcode.load(gcode_file)
-
 output_file='/var/www/fabui/application/plugins/pcbmill/python/temp/'+os.path.basename(gcode_file)
 #print output_file
 #points_file='probe.pts';
@@ -254,6 +264,9 @@ gcode.probe.zmax=zmax;
 gcode.probe.xn=xn;
 gcode.probe.yn=yn;
 gcode.probe.feed=feed;
+gcode.probe.tolerance=leveling_tolerance;
+gcode.probe.arcs=leveling_arcs;
+gcode.probe.planar=leveling_planar;
 
 gcode.probe.makeMatrix();
 gcode.probe.xstep();
@@ -264,6 +277,16 @@ gcode.probe.ystep();
 for (p,point) in enumerate(probed_points):
         gcode.probe.add(point[0]-xzero,point[1]-yzero,point[2]-zzero);
 
+# points off the regular grid or unprobed nodes are interpolated into the matrix
+if not gcode.probe.onGrid():
+	gcode.probe.fitPoints();
+
+plane = gcode.probe.fitPlane();
+if plane is not None:
+	trace("Plane fit residual: "+str(plane[3])+" mm\r\n")
+if leveling_planar and gcode.probe.activePlane() is None:
+	trace("Plane does not fit within tolerance, leveling with the probe grid\r\n")
+
 #gcode.probe.setZero(0,0)
 
 #gcode.probe.save("bCNC_probe.txt")
@@ -272,16 +295,8 @@ for (p,point) in enumerate(probed_points):
 #gcode.save("gcode_as_Read.gcode")
 
 
-lines,paths = gcode.prepare2Run(); # this autolevels the code
-
-out_file = open(output_file,"w")
-
-for line in lines:
-        if line is not None:
-                out_file.write(str(line) + "\n")
-                #self.queue.put(line+"\n")
-
-out_file.close()
+cache = CNC.LevelCache(os.path.join(os.path.dirname(output_file), "levelcache"))
+gcode.level2File(gcode_file, output_file, cache, None); # this autolevels the code on all cpus, or reuses the last leveled file
 
 if (os.path.isfile(output_file)):
 	response(output_file)
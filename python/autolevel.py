@@ -81,14 +81,5 @@ gcode.probe.save("bCNC_probe.txt")
 gcode.save("gcode_as_Read.gcode")
 
 
-lines,paths = gcode.prepare2Run(); # this autolevels the code
-
-out_file = open(output_file,"w")
-
-for line in lines:
-	if line is not None:
-		out_file.write(str(line) + "\n")
-        	#self.queue.put(line+"\n")
-
-out_file.close()
+gcode.save2Run(output_file); # this autolevels the code
 
@@ -1780,8 +1780,8 @@ def fitPlane(xyz):
 	#  / Sx2    Sxy    Sx \       / Sxz \
 	#  | Sxy    Sy2    Sy | * X = | Syz |
 	#  \ Sx     Sy     n  /       \ Sz  /
-	A = Matrix([[Sx2, Sxy, Sx], [Sxy, Sy2, Sy], [Sx, Sy, n]])
-	B = Matrix([[Sxz], [Syz], [Sz]])
+	A = Matrix([[Sx2, Sxy, n*Sx], [Sxy, Sy2, n*Sy], [n*Sx, n*Sy, n]])
+	B = Matrix([[Sxz], [Syz], [n*Sz]])
 
 	try:
 		A.inverse()
@@ -1796,8 +1796,8 @@ def fitPlane(xyz):
 	#  / Sx2    Sx \       / Sxy \
 	#  |           | * X = |     |
 	#  \ Sx     n  /       \ Sy  /
-	A = Matrix([[Sx2, Sx], [Sx, n]])
-	B = Matrix([[Sxy], [Sy]])
+	A = Matrix([[Sx2, n*Sx], [n*Sx, n]])
+	B = Matrix([[Sxy], [n*Sy]])
 	try:
 		A.inverse()
 		X = A*B
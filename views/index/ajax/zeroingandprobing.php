@@ -994,11 +994,16 @@ $.fn.textWidth = function(text, font) {
 		var meanz = 0;
                 var probenr = measurementValues[i][2].length;
 
-                for(var j = 0; j< probenr; j++) {
-                    meanz += parseFloat(measurementValues[i][2][j]); 
-                }
+                if (measurementValues[i].length > 4) {
+                    /* robust Z estimate (median) computed by the probing script */
+                    meanz = parseFloat(measurementValues[i][4]);
+                } else {
+                    for(var j = 0; j< probenr; j++) {
+                        meanz += parseFloat(measurementValues[i][2][j]); 
+                    }
 
-		meanz /= probenr;
+		    meanz /= probenr;
+                }
 
 		var temppoint = [
 		parseFloat(measurementValues[i][0]),